@@ -0,0 +1,491 @@
+"""Офлайн-бенчмарки бота остатков.
+
+Генерирует синтетический файл выгрузки (лист TDSheet) нужного размера, замеряет
+загрузку, поиск и форматирование, пропускную способность базы (коммитов в секунду), а затем прогоняет настоящие обработчики
+Application (start, handle_message, admin_button_handler) через локальный
+поддельный Bot API сервер. Сеть и настоящий Telegram не нужны.
+
+Запуск:
+    python benchmarks/bench.py --products 5000 --updates 300 --output bench_results.json
+    python benchmarks/bench.py --compare old_results.json --output new_results.json
+
+Код возврата 1, если p95 поиска под нагрузкой больше p95 обычного поиска
+более чем в --max-load-slowdown раз.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_TOKEN = "123456:BENCHMARK-TOKEN"
+BENCH_ADMIN_ID = 1000
+BENCH_USER_BASE_ID = 2000
+
+SECTIONS = ['1.UNION', '2.SPC', '2.Essence', '3.Art', '4.Creative', '4.Подложка', '5.Клей']
+
+
+def generate_workbook(path, products, shipment_dates=12, seed=42):
+    """Синтетическая выгрузка в формате 1С: заголовок в 4-й строке, разделы, товары с 6-й строки"""
+    import openpyxl
+
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('TDSheet')
+
+    first_date = datetime(2025, 11, 1)
+    dates = [(first_date + timedelta(days=7 * i)).strftime('%d.%m.%Y') for i in range(shipment_dates)]
+
+    sheet.append(['Остатки товаров на складе'])
+    sheet.append([])
+    sheet.append([])
+    sheet.append(['Номенклатура', None, 'Характеристика', 'Ед. изм.', 'В резерве', 'Доступно'] + dates)
+    sheet.append([])
+
+    articles = []
+    per_section = max(products // len(SECTIONS), 1)
+    for section in SECTIONS:
+        sheet.append([section])
+        prefix = section.split('.', 1)[1].upper()
+        for i in range(per_section):
+            name = f"{prefix} {i // 100:02d}-{i % 100:02d} {rng.choice(['Дуб', 'Ясень', 'Орех', 'Сосна'])}"
+            articles.append(name)
+            shipments = [rng.choice([None, None, None, rng.randint(1, 300)]) for _ in dates]
+            sheet.append([
+                name, None,
+                rng.choice(['м2', 'шт', None]),
+                rng.choice(['упак.', None]),
+                rng.choice([0, rng.randint(1, 50), 'Более 200']),
+                rng.choice([0, rng.randint(1, 150), 'Более 200'])
+            ] + shipments)
+    sheet.append(['Итого'])
+    workbook.save(path)
+    return articles
+
+
+def summarize(samples, total_seconds=None):
+    """Статистика по замерам в миллисекундах"""
+    ordered = sorted(samples)
+    count = len(ordered)
+
+    def percentile(p):
+        if not ordered:
+            return 0.0
+        index = min(count - 1, max(0, int(round(p / 100 * count + 0.5)) - 1))
+        return ordered[index] * 1000
+
+    result = {
+        'count': count,
+        'mean_ms': statistics.fmean(ordered) * 1000 if ordered else 0.0,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0
+    }
+    if total_seconds:
+        result['ops_per_sec'] = count / total_seconds
+    return result
+
+
+def measure(func, repeat):
+    """Замер синхронной функции repeat раз"""
+    samples = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        call_started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - call_started)
+    return summarize(samples, time.perf_counter() - started)
+
+
+def run_micro_benchmarks(bot, workbook_path, articles, args):
+    """Загрузка, поиск и форматирование без Telegram"""
+    rng = random.Random(1)
+    stock_bot = bot.stock_bot
+    results = {}
+
+    print("📥 Загрузка и разбор файла...")
+    results['ingest_read_workbook'] = measure(lambda: stock_bot._read_workbook(workbook_path), args.ingest_repeat)
+    results['ingest_load_data'] = measure(stock_bot.load_data, args.ingest_repeat)
+    # Подключение готового снимка каталога (mmap) при перезапуске, без разбора файла
+    results['ingest_restore_snapshot'] = measure(stock_bot.restore_checkpoint, args.ingest_repeat)
+
+    print("🔍 Поиск и форматирование...")
+    queries = [rng.choice(articles).split()[1] for _ in range(args.search_repeat)]
+    query_iter = iter(queries)
+    results['search_single'] = measure(lambda: stock_bot.search_products(next(query_iter)), len(queries))
+
+    scoped_iter = iter(f"UNION {query}" for query in queries)
+    results['search_scoped'] = measure(lambda: stock_bot.search_products(next(scoped_iter)), len(queries))
+
+    results['search_miss'] = measure(lambda: stock_bot.search_products('нет-такого-артикула'), args.search_repeat)
+
+    bulk_terms = [rng.sample(articles, 20) for _ in range(max(args.search_repeat // 10, 1))]
+    bulk_iter = iter(bulk_terms)
+    results['search_bulk_20'] = measure(lambda: stock_bot.search_products_bulk(next(bulk_iter)), len(bulk_terms))
+
+    products = stock_bot.products
+    format_iter = iter([rng.choice(products) for _ in range(args.search_repeat)])
+    results['format_product_info'] = measure(lambda: stock_bot.format_product_info(next(format_iter)), args.search_repeat)
+
+    return results
+
+
+def run_db_benchmarks(bot, args):
+    """Коммиты в секунду на горячих запросах к базе, последовательно и из нескольких потоков"""
+    rng = random.Random(2)
+    results = {}
+    user_ids = [BENCH_USER_BASE_ID + i for i in range(args.users)]
+    for i, user_id in enumerate(user_ids):
+        bot.update_user(user_id, f'user{i}', 'Bench', 'User')
+
+    print(f"🗄️ База данных ({bot.engine.dialect.name})...")
+    results['db_get_user'] = measure(lambda: bot.get_user(rng.choice(user_ids)), args.db_repeat)
+    # Каждый update_user существующего пользователя - отдельный коммит
+    results['db_update_user'] = measure(
+        lambda: bot.update_user(rng.choice(user_ids), 'bench', 'Bench', 'User'), args.db_repeat
+    )
+
+    samples = []
+
+    def timed_update(user_id):
+        call_started = time.perf_counter()
+        bot.update_user(user_id, 'bench', 'Bench', 'User')
+        samples.append(time.perf_counter() - call_started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(timed_update, [rng.choice(user_ids) for _ in range(args.db_repeat)]))
+    results['db_update_user_threads'] = summarize(samples, time.perf_counter() - started)
+
+    # Без JobQueue каждая запись журнала сбрасывается сразу: 100 коммитов подряд
+    def log_batch():
+        for i in range(100):
+            bot.log_admin_action(BENCH_ADMIN_ID, 'bench', i)
+        bot.flush_admin_logs()
+
+    results['db_admin_log_inline_100'] = measure(log_batch, max(args.db_repeat // 50, 1))
+    return results
+
+
+class FakeBotApi:
+    """Поддельный Bot API: отвечает на вызовы как Telegram и считает их"""
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self.message_id = 0
+
+    def _message(self, chat_id, text=None):
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(params.get('chat_id', BENCH_ADMIN_ID), params.get('text', ''))
+        elif method == 'sendDocument':
+            result = self._message(params.get('chat_id', BENCH_ADMIN_ID))
+            result['document'] = {'file_id': 'bench', 'file_unique_id': 'bench'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post('/{prefix}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class UpdateFactory:
+    """Сборка JSON апдейтов Telegram для обработчиков"""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user_id, text):
+        update_id = self._next_id()
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+                'chat_instance': 'bench',
+                'data': data,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'Панель администратора'
+                }
+            }
+        }
+
+
+async def drive_updates(application, payloads, concurrency):
+    """Прогон апдейтов через обработчики с заданным параллелизмом"""
+    from telegram import Update
+
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def run_one(payload):
+        async with semaphore:
+            update = Update.de_json(payload, application.bot)
+            started = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(payload) for payload in payloads))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def build_scenarios(articles, args):
+    """Сценарии сквозного прогона: название -> список апдейтов"""
+    rng = random.Random(7)
+    factory = UpdateFactory()
+    users = [BENCH_USER_BASE_ID + i for i in range(args.users)]
+
+    return {
+        'start': [factory.message(rng.choice(users), '/start') for _ in range(args.updates)],
+        'search': [
+            factory.message(rng.choice(users), rng.choice(articles).split()[1])
+            for _ in range(args.updates)
+        ],
+        'search_bulk': [
+            factory.message(rng.choice(users), "\n".join(rng.sample(articles, 10)))
+            for _ in range(max(args.updates // 5, 1))
+        ],
+        'admin_stats': [factory.callback(BENCH_ADMIN_ID, 'admin_stats') for _ in range(max(args.updates // 5, 1))]
+    }
+
+
+def build_load_scenario(articles, args):
+    """Поиск во время тяжелых операций: (тяжелые апдейты, простые поиски)"""
+    rng = random.Random(11)
+    factory = UpdateFactory()
+    users = [BENCH_USER_BASE_ID + i for i in range(args.users)]
+
+    heavy = [factory.message(BENCH_ADMIN_ID, '/export csv') for _ in range(args.heavy_updates)]
+    heavy += [
+        factory.message(rng.choice(users), "\n".join(rng.sample(articles, 50)))
+        for _ in range(args.heavy_updates)
+    ]
+    light = [factory.message(rng.choice(users), rng.choice(articles).split()[1]) for _ in range(args.updates)]
+    return heavy, light
+
+
+async def run_end_to_end(bot, articles, args):
+    """Сквозной прогон настоящего Application через поддельный Bot API"""
+    from telegram.ext import Application
+
+    fake_api = FakeBotApi(latency_ms=args.api_latency_ms)
+    base_url = await fake_api.start()
+
+    # Пользователи заранее подтверждены, чтобы замерять основной путь обработки
+    for i in range(args.users):
+        user_id = BENCH_USER_BASE_ID + i
+        bot.update_user(user_id, f'user{i}', 'Bench', 'User')
+        bot.approve_user(user_id)
+
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN).base_url(base_url))
+    results = {}
+    try:
+        await application.initialize()
+        for name, payloads in build_scenarios(articles, args).items():
+            print(f"🤖 Сценарий {name}: {len(payloads)} апдейтов...")
+            results[name] = await drive_updates(application, payloads, args.concurrency)
+
+        # Хвост задержки простого поиска, пока параллельно идут выгрузки и поиск по длинным спискам
+        heavy, light = build_load_scenario(articles, args)
+        print(f"🤖 Сценарий search_under_load: {len(light)} поисков на фоне {len(heavy)} тяжелых апдейтов...")
+        heavy_task = asyncio.create_task(drive_updates(application, heavy, len(heavy)))
+        await asyncio.sleep(0)
+        results['search_under_load'] = await drive_updates(application, light, args.concurrency)
+        results['heavy_under_load'] = await heavy_task
+    finally:
+        await application.shutdown()
+        await fake_api.stop()
+
+    return results, dict(fake_api.calls)
+
+
+def check_load_slowdown(e2e, max_slowdown):
+    """Хвост поиска под нагрузкой не должен превышать хвост обычного поиска больше чем в max_slowdown раз"""
+    baseline = e2e['search']['p95_ms']
+    loaded = e2e['search_under_load']['p95_ms']
+    limit = baseline * max_slowdown
+    if loaded > limit:
+        print(
+            f"❌ search_under_load: p95 {loaded:.3f} мс больше допустимых {limit:.3f} мс "
+            f"(search p95 {baseline:.3f} мс × {max_slowdown:g})"
+        )
+        return False
+    print(f"✅ search_under_load: p95 {loaded:.3f} мс в пределах {limit:.3f} мс (×{max_slowdown:g} от search)")
+    return True
+
+
+def git_revision():
+    """Текущая ревизия репозитория для сравнения результатов между версиями"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare_results(old, new):
+    """Печать изменения p50/p95 относительно предыдущего файла результатов"""
+    print(f"\n📊 Сравнение с {old['meta'].get('revision')} ({old['meta'].get('timestamp')}):")
+    for group in ('micro', 'db', 'e2e'):
+        for name, stats in new.get(group, {}).items():
+            previous = old.get(group, {}).get(name)
+            if not previous:
+                continue
+            for key in ('p50_ms', 'p95_ms'):
+                before, after = previous.get(key, 0), stats.get(key, 0)
+                change = (after - before) / before * 100 if before else 0.0
+                print(f"  {group}.{name}.{key}: {before:.3f} -> {after:.3f} мс ({change:+.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота остатков")
+    parser.add_argument('--products', type=int, default=5000, help="товаров в синтетическом файле")
+    parser.add_argument('--shipment-dates', type=int, default=12, help="столбцов с датами поставок")
+    parser.add_argument('--ingest-repeat', type=int, default=3, help="повторов загрузки файла")
+    parser.add_argument('--search-repeat', type=int, default=500, help="запросов в микробенчмарках поиска")
+    parser.add_argument('--db-repeat', type=int, default=500, help="операций в бенчмарках базы")
+    parser.add_argument('--updates', type=int, default=200, help="апдейтов в сквозных сценариях")
+    parser.add_argument('--users', type=int, default=50, help="подтвержденных пользователей")
+    parser.add_argument('--concurrency', type=int, default=8, help="одновременных апдейтов")
+    parser.add_argument('--heavy-updates', type=int, default=10, help="тяжелых апдейтов в сценарии под нагрузкой")
+    parser.add_argument('--max-load-slowdown', type=float, default=3.0,
+                        help="во сколько раз p95 поиска под нагрузкой может превышать p95 обычного поиска")
+    parser.add_argument('--api-latency-ms', type=float, default=0, help="задержка ответа поддельного Bot API")
+    parser.add_argument('--skip-e2e', action='store_true', help="только микробенчмарки")
+    parser.add_argument('--output', default='bench_results.json', help="файл результатов (JSON)")
+    parser.add_argument('--compare', help="предыдущий файл результатов для сравнения")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_path = os.path.abspath(args.output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # Бот работает в отдельной временной папке: своя база SQLite и свой файл остатков
+    workdir = tempfile.mkdtemp(prefix='stockbot-bench-')
+    workbook_path = os.path.join(workdir, 'bench.xlsx')
+    print(f"🧪 Генерация файла на {args.products} товаров в {workdir}...")
+    articles = generate_workbook(workbook_path, args.products, args.shipment_dates)
+
+    os.environ.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_ID': str(BENCH_ADMIN_ID),
+        'DATA_SOURCES': json.dumps([{'warehouse': 'Санкт-Петербург', 'type': 'local', 'filename': workbook_path}])
+    })
+    os.environ.pop('RENDER', None)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import_started = time.perf_counter()
+    import bot
+    import_seconds = time.perf_counter() - import_started
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'import_seconds': import_seconds
+        },
+        'micro': run_micro_benchmarks(bot, workbook_path, articles, args),
+        'db': run_db_benchmarks(bot, args)
+    }
+
+    if not args.skip_e2e:
+        results['e2e'], results['api_calls'] = asyncio.run(run_end_to_end(bot, articles, args))
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print("\n📈 Результаты:")
+    for group in ('micro', 'db', 'e2e'):
+        for name, stats in results.get(group, {}).items():
+            print(
+                f"  {group}.{name}: p50 {stats['p50_ms']:.3f} мс, p95 {stats['p95_ms']:.3f} мс, "
+                f"{stats.get('ops_per_sec', 0):.1f} оп/с"
+            )
+    print(f"💾 Сохранено в {output_path}")
+
+    if compare_path:
+        with open(compare_path, encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+
+    # Проверка идет после сохранения и сравнения, чтобы результаты провального прогона остались для разбора
+    if not args.skip_e2e and not check_load_slowdown(results['e2e'], args.max_load_slowdown):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,16 @@
+import time
+
+# Профиль запуска: длительность групп импортов и этапов инициализации, выводится в лог после старта.
+# Разбивка по отдельным модулям: python -X importtime bot.py
+_startup = {'mark': time.perf_counter(), 'phases': []}
+
+def startup_mark(phase):
+    """Конец этапа запуска: время с предыдущей отметки попадает в профиль"""
+    now = time.perf_counter()
+    _startup['phases'].append((phase, now - _startup['mark']))
+    _startup['mark'] = now
+
 import os
-import openpyxl
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 import ftplib
 import io
 import logging
@@ -9,12 +18,41 @@ from datetime import datetime, timedelta
 import asyncio
 import re
 import json
-import pytz
-import requests
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text
+import html
+import hmac
+import mmap
+import struct
+import signal
+import csv
+import tempfile
+import threading
+import functools
+import contextlib
+import heapq
+from collections import deque
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, wait
+import zlib
+startup_mark("импорт: стандартная библиотека")
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest
+startup_mark("импорт: telegram")
+
+from sqlalchemy import create_engine, event, select, insert, update, bindparam, Column, Integer, BigInteger, String, Boolean, Date, DateTime, Text, func, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+startup_mark("импорт: sqlalchemy")
+
+import pytz
 from dotenv import load_dotenv
+# openpyxl (~0.1 с импорта) подключается при первом чтении или записи книги, а не при запуске
 
 # Подавление предупреждений SQLAlchemy 2.0
 import warnings
@@ -35,12 +73,117 @@ FTP_PASSWORD = os.environ.get('FTP_PASSWORD')
 FTP_PATH = os.environ.get('FTP_PATH', '/')
 FTP_FILENAME = os.environ.get('FTP_FILENAME', "Ostatki dlya bota (XLSX).xlsx")
 
-# Настройка базы данных - используем SQLite для совместимости
-DATABASE_URL = 'sqlite:///bot_data.db'
+# Склады и источники данных. По умолчанию - один склад с файлом на FTP
+# и локальной копией. Список источников задается JSON в DATA_SOURCES, например:
+# [{"warehouse": "Москва", "type": "ftp", "filename": "Ostatki MSK.xlsx"},
+#  {"warehouse": "Казань", "type": "local", "filename": "kazan.xlsx"}]
+WAREHOUSE_NAME = os.environ.get('WAREHOUSE_NAME', 'Санкт-Петербург')
+DATA_SOURCES = os.environ.get('DATA_SOURCES')
+# Сколько ждать источник при загрузке, прежде чем показать данные остальных складов
+SOURCE_TIMEOUT = int(os.environ.get('SOURCE_TIMEOUT', 60))
+FTP_TIMEOUT = int(os.environ.get('FTP_TIMEOUT', 30))
+
+# Настройка базы данных - по умолчанию SQLite, DATABASE_URL переключает на PostgreSQL
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///bot_data.db')
+if DATABASE_URL.startswith('postgres://'):
+    # Render и Heroku отдают устаревшую схему, которую SQLAlchemy 1.4 не принимает
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
+DB_BUSY_TIMEOUT = int(os.environ.get('DB_BUSY_TIMEOUT', 10))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
+# Общая папка нескольких экземпляров бота: блокировка выбора обновляющего и общий снимок каталога
+SHARED_DIR = os.environ.get('SHARED_DIR')
+SHARED_SYNC_INTERVAL = int(os.environ.get('SHARED_SYNC_INTERVAL', 15))
+
+# Контрольная точка каталога для быстрого перезапуска (при SHARED_DIR - общий снимок для всех экземпляров)
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH') or os.path.join(SHARED_DIR or '.', 'stock_snapshot.bin')
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', 24 * 60 * 60))
+SNAPSHOT_VERSION = 4
+RESTORED_SUFFIX = " (контрольная точка)"
+# Сколько ждать каждый шаг остановки (сброс буферов, контрольная точка, отправка очередей)
+SHUTDOWN_TIMEOUT = int(os.environ.get('SHUTDOWN_TIMEOUT', 10))
+
+# Адаптивное автообновление: дешевая проверка времени файла (MDTM) от раза в минуту
+# около обычного времени выгрузки до раза в AUTO_UPDATE_MAX_INTERVAL при простое
+AUTO_UPDATE_MIN_INTERVAL = int(os.environ.get('AUTO_UPDATE_MIN_INTERVAL', 60))
+AUTO_UPDATE_MAX_INTERVAL = int(os.environ.get('AUTO_UPDATE_MAX_INTERVAL', 30 * 60))
+AUTO_UPDATE_EXPECTED_WINDOW = 15 * 60
+AUTO_UPDATE_HISTORY_SIZE = 100
+AUTO_UPDATE_WINDOW = os.environ.get('AUTO_UPDATE_WINDOW', 'always')
+# Рабочие окна: (дни недели, начало и конец в минутах от полуночи); вне окна - редкие проверки
+UPDATE_WINDOW_PRESETS = {
+    'always': ("Круглосуточно", None),
+    'workdays': ("Будни 8:00–20:00", [((0, 1, 2, 3, 4), 8 * 60, 20 * 60)]),
+    'workdays_sat': ("Будни 8:00–20:00, сб 9:00–15:00", [((0, 1, 2, 3, 4), 8 * 60, 20 * 60), ((5,), 9 * 60, 15 * 60)])
+}
+
+# Параллельная обработка апдейтов: легкая полоса (поиск, отказы в доступе) и тяжелая (выгрузки,
+# админ-действия) со своими лимитами, чтобы тяжелые операции не задерживали поиск
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 64))
+HEAVY_UPDATE_CONCURRENCY = int(os.environ.get('HEAVY_UPDATE_CONCURRENCY', 4))
+# Предел очереди: сверх него тяжелые запросы отклоняются, а webhook отвечает 503 (Telegram повторит позже)
+HEAVY_QUEUE_LIMIT = int(os.environ.get('HEAVY_QUEUE_LIMIT', 20))
+UPDATE_QUEUE_LIMIT = int(os.environ.get('UPDATE_QUEUE_LIMIT', 1000))
+HEAVY_COMMANDS = ('/export', '/logs', '/users')
+HEAVY_CALLBACKS = ('admin_update', 'admin_logs', 'admin_users', 'admin_pending', 'admin_blocked', 'admin_find', 'admin_stats')
+
+# Сводка по остаткам: сколько позиций показывать в топе по резерву и до какого остатка товар "заканчивается"
+DASHBOARD_TOP_N = int(os.environ.get('DASHBOARD_TOP_N', 10))
+LOW_STOCK_THRESHOLD = float(os.environ.get('LOW_STOCK_THRESHOLD', 5))
 
 # Локальный файл для резервного копирования
 LOCAL_FILENAME = "Ostatki dlya bota (XLSX).xlsx"
 
+# Массовый поиск: больше строк в ответе - отправляем файлом
+BULK_MAX_TERMS = 200
+BULK_MAX_ROWS_IN_MESSAGE = 30
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Служебные строки листа, которые не являются товарами
+SKIP_KEYWORDS = ['Остатки', 'Номенклатура', 'Итого']
+# Заголовки разделов каталога: товары ниже относятся к этому разделу
+SECTION_KEYWORDS = ['1.UNION', '2.SPC', '2.Essence', '3.Art', '4.Creative', '4.Подложка', '5.Клей']
+SECTION_PATTERN = re.compile(r'^\s*\d+\.\s*([^\d\s]\S*)\s*$')
+
+# Схема листа выгрузки из 1С. Столбцы с подписями ищутся по тексту заголовка
+# в первых probe_rows строках, поэтому лишний столбец в выгрузке не сдвигает данные.
+# Позиции column используются только для столбцов без подписей.
+# Переопределяется JSON в переменной окружения SHEET_SCHEMA.
+DEFAULT_SHEET_SCHEMA = {
+    'sheet_name': 'TDSheet',
+    'probe_rows': 10,
+    'columns': {
+        'name': {'labels': ['Номенклатура', 'Наименование'], 'column': 1, 'required': True},
+        'info_c': {'labels': [], 'column': 3, 'required': False},
+        'info_d': {'labels': [], 'column': 4, 'required': False},
+        'reserve': {'labels': ['В резерве', 'Резерв'], 'column': 5, 'required': True},
+        'available': {'labels': ['Доступно'], 'column': 6, 'required': True}
+    },
+    # Даты поставок - ячейки с датой в строке заголовка правее столбца "Доступно"
+    'min_shipment_dates': 0,
+    # Первая строка данных: в выгрузке 1С под строкой дат идет строка подзаголовков, товары - с 6-й строки.
+    # None - сразу после найденных строк заголовка
+    'data_start_row': 6
+}
+
+# Метрики: HTTP endpoint /metrics (порт из PORT, как на Render) и сводка в админ-панели.
+# Порт публичный, поэтому /metrics отдается только с заголовком "Authorization: Bearer <METRICS_TOKEN>";
+# без METRICS_TOKEN endpoint не подключается, сводка в админ-панели работает как раньше
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() != 'false'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+HTTP_PORT = int(os.environ.get('PORT', 8080))
+
+# Режим webhook: Telegram присылает апдейты на WEBHOOK_URL, а принявший экземпляр
+# передает их экземпляру WORKER_URLS[user_id % N], чтобы все апдейты пользователя обрабатывал один процесс.
+# WEBHOOK_SECRET обязателен: им подписаны и апдейты от Telegram, и пересылки между экземплярами
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_PATH = '/telegram'
+WORKER_URLS = [url.strip().rstrip('/') for url in os.environ.get('WORKER_URLS', '').split(',') if url.strip()]
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', 0))
+ROUTED_HEADER = 'X-Stock-Bot-Routed'
+
 # Московский часовой пояс
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
@@ -51,46 +194,277 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class Metrics:
+    """Счетчики и гистограммы в формате Prometheus без внешних зависимостей"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # (имя, метки) -> [счетчики по корзинам, сумма, количество]
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Увеличение счетчика"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Установка текущего значения (gauge)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Добавление значения в гистограмму"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        bucket = bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, name, **labels):
+        """Контекстный менеджер: длительность блока попадает в гистограмму"""
+        return _MetricsTimer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """Декоратор для измерения времени выполнения функции"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+    def render(self):
+        """Текст метрик в формате Prometheus exposition"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, 'counter')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        """Сводка гистограммы по всем меткам: (количество, среднее, p95 по корзинам) в секундах"""
+        with self._lock:
+            histograms = [value for (metric, _), value in self._histograms.items() if metric == name]
+            counts = [0] * (len(self.BUCKETS) + 1)
+            total, count = 0.0, 0
+            for buckets, histogram_sum, histogram_count in histograms:
+                counts = [a + b for a, b in zip(counts, buckets)]
+                total += histogram_sum
+                count += histogram_count
+
+        if not count:
+            return 0, 0.0, 0.0
+        threshold = count * 0.95
+        cumulative = 0
+        p95 = self.BUCKETS[-1]
+        for bound, bucket_count in zip(self.BUCKETS, counts):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                p95 = bound
+                break
+        return count, total / count, p95
+
+    def counter_total(self, name):
+        """Сумма счетчика по всем меткам"""
+        with self._lock:
+            return sum(value for (metric, _), value in self._counters.items() if metric == name)
+
+class _MetricsTimer:
+    """Замер длительности блока для Metrics.timer"""
+
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+metrics = Metrics(enabled=METRICS_ENABLED)
+
 # Инициализация базы данных SQLite
 Base = declarative_base()
 
+# ID Telegram уже больше 2^31 - в PostgreSQL для них нужен bigint
 class User(Base):
     __tablename__ = 'users'
     
-    user_id = Column(Integer, primary_key=True)
-    username = Column(String(100))
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    username = Column(String(100), index=True)
     first_name = Column(String(100))
     last_name = Column(String(100))
-    is_blocked = Column(Boolean, default=False)
-    is_approved = Column(Boolean, default=False)
+    is_blocked = Column(Boolean, default=False, index=True)
+    is_approved = Column(Boolean, default=False, index=True)
     block_reason = Column(Text)
     block_until = Column(DateTime)
     request_count = Column(Integer, default=0)
-    first_seen = Column(DateTime)
-    last_seen = Column(DateTime)
+    first_seen = Column(DateTime, index=True)
+    last_seen = Column(DateTime, index=True)
     approval_requested = Column(DateTime)
 
 class AdminLog(Base):
     __tablename__ = 'admin_logs'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    admin_id = Column(Integer)
-    action = Column(String(200))
-    target_user_id = Column(Integer)
+    admin_id = Column(BigInteger)
+    action = Column(String(200), index=True)
+    target_user_id = Column(BigInteger, index=True)
     details = Column(Text)
-    timestamp = Column(DateTime)
+    timestamp = Column(DateTime, index=True)
+
+class AdminLogDaily(Base):
+    """Дневные итоги по действиям из логов старше срока хранения"""
+    __tablename__ = 'admin_logs_daily'
+
+    day = Column(Date, primary_key=True)
+    action = Column(String(200), primary_key=True)
+    count = Column(Integer, default=0)
+
+def create_db_engine(url=DATABASE_URL):
+    """Engine с пулом соединений; для SQLite - WAL, synchronous=NORMAL и ожидание блокировки"""
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+
+    # Соединения переиспользуются разными потоками (обработчики, фоновое обновление)
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        connect_args={'check_same_thread': False, 'timeout': DB_BUSY_TIMEOUT}
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL: чтение не блокируется записью; NORMAL: fsync только на чекпоинтах WAL
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}")
+        cursor.close()
+
+    return engine
+
+def schema_fingerprint():
+    """Отпечаток схемы (таблицы, столбцы и индексы) - меняется при любом изменении моделей"""
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{column.name}:{column.type}" for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    return zlib.crc32("|".join(parts).encode('utf-8')) & 0x7fffffff
+
+def widen_id_columns(engine):
+    """PostgreSQL: перевод столбцов с ID Telegram из integer в bigint в таблицах, созданных раньше"""
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for column in table.columns:
+                if not isinstance(column.type, BigInteger):
+                    continue
+                data_type = connection.exec_driver_sql(
+                    "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+                    (table.name, column.name)
+                ).scalar()
+                if data_type == 'integer':
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT')
+                    logger.info(f"🔧 {table.name}.{column.name}: integer -> bigint")
 
 # Инициализация базы данных
 def init_db():
     try:
-        engine = create_engine(DATABASE_URL)
+        engine = create_db_engine()
+        # SQLite хранит отпечаток схемы в PRAGMA user_version: если он совпадает, таблицы и индексы
+        # уже созданы и проверять каждую таблицу при запуске не нужно
+        sqlite = engine.dialect.name == 'sqlite'
+        fingerprint = schema_fingerprint()
+        if sqlite:
+            with engine.connect() as connection:
+                if connection.exec_driver_sql("PRAGMA user_version").scalar() == fingerprint:
+                    logger.info("✅ База данных sqlite: схема актуальна")
+                    return engine
+
         Base.metadata.create_all(engine)
-        logger.info("✅ База данных SQLite инициализирована")
+        # create_all не добавляет новые индексы в уже существующие таблицы
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        if engine.dialect.name == 'postgresql':
+            widen_id_columns(engine)
+        if sqlite:
+            with engine.begin() as connection:
+                connection.exec_driver_sql(f"PRAGMA user_version = {fingerprint}")
+        logger.info(f"✅ База данных {engine.dialect.name} инициализирована")
         return engine
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации базы данных: {e}")
         return None
 
+startup_mark("настройки и модели")
+
 # Глобальный engine для базы данных
 try:
     engine = init_db()
@@ -101,53 +475,91 @@ try:
 except Exception as e:
     logger.error(f"❌ Критическая ошибка базы данных: {e}")
     raise
+startup_mark("база данных")
+
+# Размер страницы списков пользователей в админ-панели
+ADMIN_PAGE_SIZE = 15
+ADMIN_PENDING_PAGE_SIZE = 8
+
+# Журнал действий администратора: буфер записи, срок хранения и размер страницы
+ADMIN_LOG_FLUSH_INTERVAL = 5
+ADMIN_LOG_BUFFER_LIMIT = 500
+ADMIN_LOG_RETENTION_DAYS = int(os.environ.get('ADMIN_LOG_RETENTION_DAYS', 90))
+ADMIN_LOG_PAGE_SIZE = 15
+_admin_log_buffer = deque()
+_admin_log_flush_lock = threading.Lock()
+
+# Уведомления администратора о запросах доступа: повтор не чаще раза в кулдаун,
+# запросы, пришедшие в течение APPROVAL_DIGEST_DELAY секунд, собираются в одно сообщение
+APPROVAL_NOTIFY_COOLDOWN = int(os.environ.get('APPROVAL_NOTIFY_COOLDOWN', 6 * 60 * 60))
+APPROVAL_DIGEST_DELAY = int(os.environ.get('APPROVAL_DIGEST_DELAY', 15))
+APPROVAL_DIGEST_MAX_BUTTONS = 10
+_approval_notified = {}
+_approval_digest = {}
+
+# Кэш статистики пользователей для админ-панели
+STATS_CACHE_TTL = 30
+_stats_cache = {'value': None, 'expires': 0.0}
+
+def moscow_now():
+    """Текущее московское время без часового пояса - в таком виде даты хранятся в базе"""
+    return datetime.now(MOSCOW_TZ).replace(tzinfo=None)
 
 # Функции для работы с базой данных
+# Заранее собранные запросы для горячего пути: SQLAlchemy кэширует их компиляцию,
+# а драйвер - подготовленные выражения на соединениях из пула
+users_table = User.__table__
+SELECT_USER = select(users_table).where(users_table.c.user_id == bindparam('uid'))
+TOUCH_USER = update(users_table).where(users_table.c.user_id == bindparam('uid')).values(
+    username=bindparam('username'),
+    first_name=bindparam('first_name'),
+    last_name=bindparam('last_name'),
+    last_seen=bindparam('now'),
+    request_count=users_table.c.request_count + 1
+)
+INSERT_USER = insert(users_table)
+
+@metrics.timed('bot_db_seconds', op='get_user')
 def get_user(user_id):
-    session = Session()
     try:
-        user = session.query(User).filter(User.user_id == user_id).first()
-        return user
+        with engine.connect() as connection:
+            return connection.execute(SELECT_USER, {'uid': user_id}).first()
     except Exception as e:
         logger.error(f"Ошибка при получении пользователя: {e}")
         return None
-    finally:
-        session.close()
 
+@metrics.timed('bot_db_seconds', op='update_user')
 def update_user(user_id, username, first_name, last_name):
-    session = Session()
+    now = moscow_now()
+    params = {'uid': user_id, 'username': username, 'first_name': first_name, 'last_name': last_name, 'now': now}
     try:
-        user = get_user(user_id)
-        now = datetime.now(MOSCOW_TZ)
-        
-        if user:
-            user.username = username
-            user.first_name = first_name
-            user.last_name = last_name
-            user.last_seen = now
-            user.request_count += 1
-        else:
-            is_approved = True if user_id == ADMIN_ID else False
-            user = User(
-                user_id=user_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                first_seen=now,
-                last_seen=now,
-                request_count=1,
-                approval_requested=now,
-                is_approved=is_approved
-            )
-            session.add(user)
-        
-        session.commit()
+        with engine.begin() as connection:
+            if connection.execute(TOUCH_USER, params).rowcount:
+                return
+
+        try:
+            with engine.begin() as connection:
+                connection.execute(INSERT_USER, {
+                    'user_id': user_id,
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'first_seen': now,
+                    'last_seen': now,
+                    'request_count': 1,
+                    'approval_requested': now,
+                    'is_approved': user_id == ADMIN_ID,
+                    'is_blocked': False
+                })
+            invalidate_user_stats()
+        except IntegrityError:
+            # Параллельный апдейт того же нового пользователя уже создал запись
+            with engine.begin() as connection:
+                connection.execute(TOUCH_USER, params)
     except Exception as e:
         logger.error(f"Ошибка при обновлении пользователя: {e}")
-        session.rollback()
-    finally:
-        session.close()
 
+@metrics.timed('bot_db_seconds', op='approve_user')
 def approve_user(user_id):
     session = Session()
     try:
@@ -155,12 +567,14 @@ def approve_user(user_id):
         if user:
             user.is_approved = True
             session.commit()
+            invalidate_user_stats()
     except Exception as e:
         logger.error(f"Ошибка при подтверждении пользователя: {e}")
         session.rollback()
     finally:
         session.close()
 
+@metrics.timed('bot_db_seconds', op='block_user')
 def block_user(user_id, reason="Не указана", block_until=None):
     session = Session()
     try:
@@ -170,12 +584,16 @@ def block_user(user_id, reason="Не указана", block_until=None):
             user.block_reason = reason
             user.block_until = block_until
             session.commit()
+            invalidate_user_stats()
+            if block_until:
+                schedule_block_expiry()
     except Exception as e:
         logger.error(f"Ошибка при блокировке пользователя: {e}")
         session.rollback()
     finally:
         session.close()
 
+@metrics.timed('bot_db_seconds', op='unblock_user')
 def unblock_user(user_id):
     session = Session()
     try:
@@ -185,53 +603,316 @@ def unblock_user(user_id):
             user.block_reason = None
             user.block_until = None
             session.commit()
+            invalidate_user_stats()
     except Exception as e:
         logger.error(f"Ошибка при разблокировке пользователя: {e}")
         session.rollback()
     finally:
         session.close()
 
-def get_all_users():
+@metrics.timed('bot_db_seconds', op='expire_blocks')
+def expire_blocks(now=None):
+    """Снятие всех истекших временных блокировок в одной транзакции, возвращает ID разблокированных"""
+    now = now or moscow_now()
+    expired = (User.is_blocked == True) & (User.block_until != None) & (User.block_until <= now)
     session = Session()
     try:
-        users = session.query(User).order_by(User.last_seen.desc()).all()
-        return users
+        candidates = [row[0] for row in session.query(User.user_id).filter(expired).all()]
+        # Построчный UPDATE с повторной проверкой условия: если блокировку уже снял
+        # другой экземпляр бота, пользователь не получит второе уведомление
+        user_ids = [
+            user_id for user_id in candidates
+            if session.query(User).filter(expired, User.user_id == user_id).update(
+                {User.is_blocked: False, User.block_reason: None, User.block_until: None},
+                synchronize_session=False
+            )
+        ]
+        session.commit()
+        if user_ids:
+            invalidate_user_stats()
+        return user_ids
     except Exception as e:
-        logger.error(f"Ошибка при получении списка пользователей: {e}")
+        logger.error(f"Ошибка при снятии истекших блокировок: {e}")
+        session.rollback()
         return []
     finally:
         session.close()
 
-def get_pending_approvals():
+def next_block_expiry():
+    """Ближайшее время окончания временной блокировки или None"""
+    session = Session()
+    try:
+        return session.query(func.min(User.block_until)).filter(
+            User.is_blocked == True, User.block_until != None
+        ).scalar()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске ближайшей разблокировки: {e}")
+        return None
+    finally:
+        session.close()
+
+# JobQueue приложения для задач, назначаемых из синхронного кода (задается в build_application)
+_scheduler = {'job_queue': None}
+
+def schedule_block_expiry():
+    """Переназначение единственной задачи снятия блокировок на ближайший block_until"""
+    job_queue = _scheduler['job_queue']
+    if not job_queue:
+        return
+
+    for job in job_queue.get_jobs_by_name('block_expiry'):
+        job.schedule_removal()
+
+    when = next_block_expiry()
+    if when:
+        # block_until хранится в московском времени без часового пояса; просроченные снимаем сразу
+        delay = max((when - moscow_now()).total_seconds(), 0)
+        job_queue.run_once(block_expiry_job, when=delay, name='block_expiry')
+        logger.info(f"⏱️ Ближайшее снятие блокировки: {when.strftime('%d.%m.%Y %H:%M')}")
+
+@metrics.timed('bot_db_seconds', op='get_user_stats')
+def get_user_stats():
+    """Статистика пользователей одним агрегирующим запросом, с кэшем на STATS_CACHE_TTL секунд"""
+    if _stats_cache['value'] is not None and time.monotonic() < _stats_cache['expires']:
+        return _stats_cache['value']
+
+    session = Session()
+    try:
+        active_since = moscow_now() - timedelta(days=1)
+        row = session.query(
+            func.count(User.user_id),
+            func.sum(case((User.is_approved == True, 1), else_=0)),
+            func.sum(case(((User.is_approved == False) & (User.is_blocked == False) & (User.user_id != ADMIN_ID), 1), else_=0)),
+            func.sum(case((User.is_blocked == True, 1), else_=0)),
+            func.sum(case((User.last_seen >= active_since, 1), else_=0)),
+            func.sum(User.request_count)
+        ).one()
+
+        stats = {
+            'total': row[0] or 0,
+            'approved': row[1] or 0,
+            'pending': row[2] or 0,
+            'blocked': row[3] or 0,
+            'active_today': row[4] or 0,
+            'total_requests': row[5] or 0
+        }
+        _stats_cache['value'] = stats
+        _stats_cache['expires'] = time.monotonic() + STATS_CACHE_TTL
+        return stats
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики пользователей: {e}")
+        return None
+    finally:
+        session.close()
+
+def load_approval_state():
+    """Восстановление времени уведомлений при запуске по approval_requested ожидающих пользователей"""
     session = Session()
     try:
-        users = session.query(User).filter(
+        since = moscow_now() - timedelta(seconds=APPROVAL_NOTIFY_COOLDOWN)
+        rows = session.query(User.user_id, User.approval_requested).filter(
             User.is_approved == False,
             User.is_blocked == False,
-            User.user_id != ADMIN_ID
-        ).order_by(User.first_seen.desc()).all()
-        return users
+            User.approval_requested >= since
+        ).all()
+        _approval_notified.clear()
+        _approval_notified.update({user_id: requested for user_id, requested in rows})
+        return len(rows)
     except Exception as e:
-        logger.error(f"Ошибка при получении ожидающих подтверждения: {e}")
-        return []
+        logger.error(f"Ошибка при загрузке запросов на доступ: {e}")
+        return 0
+    finally:
+        session.close()
+
+def forget_approval_request(user_id):
+    """Сброс состояния запроса после решения администратора"""
+    _approval_notified.pop(user_id, None)
+    _approval_digest.pop(user_id, None)
+
+def invalidate_user_stats():
+    """Сброс кэша статистики после изменения статуса пользователя"""
+    _stats_cache['value'] = None
+
+# Списки админ-панели: фильтр и столбец сортировки для постраничного вывода
+USER_LIST_KINDS = {
+    'users': lambda: (None, User.last_seen),
+    'pending': lambda: (
+        (User.is_approved == False) & (User.is_blocked == False) & (User.user_id != ADMIN_ID),
+        User.first_seen
+    ),
+    'blocked': lambda: ((User.is_blocked == True) & (User.user_id != ADMIN_ID), User.last_seen)
+}
+
+def encode_cursor(user, sort_column):
+    """Курсор страницы для callback_data: время сортировки и ID последнего пользователя"""
+    sort_value = getattr(user, sort_column.key)
+    sort_str = sort_value.strftime('%Y%m%d%H%M%S%f') if sort_value else '0'
+    return f"{sort_str}.{user.user_id}"
+
+def decode_cursor(cursor):
+    """Разбор курсора страницы, None - первая страница"""
+    if not cursor:
+        return None
+    sort_str, user_id = cursor.split('.')
+    sort_value = datetime.strptime(sort_str, '%Y%m%d%H%M%S%f') if sort_str != '0' else None
+    return sort_value, int(user_id)
+
+@metrics.timed('bot_db_seconds', op='get_users_page')
+def get_users_page(kind, cursor=None, limit=ADMIN_PAGE_SIZE, search=None):
+    """Страница списка пользователей (keyset-пагинация), возвращает (пользователи, курсор следующей страницы)"""
+    session = Session()
+    try:
+        condition, sort_column = USER_LIST_KINDS[kind]()
+        query = session.query(User)
+        if condition is not None:
+            query = query.filter(condition)
+
+        if search:
+            search = search.strip().lstrip('@')
+            if search.isdigit():
+                query = query.filter(User.user_id == int(search))
+            else:
+                pattern = f"{search}%"
+                query = query.filter(
+                    User.username.like(pattern) | User.first_name.like(pattern) | User.last_name.like(pattern)
+                )
+
+        position = decode_cursor(cursor)
+        if position:
+            sort_value, user_id = position
+            if sort_value is None:
+                query = query.filter(sort_column.is_(None), User.user_id < user_id)
+            else:
+                query = query.filter(
+                    (sort_column < sort_value) |
+                    ((sort_column == sort_value) & (User.user_id < user_id)) |
+                    sort_column.is_(None)
+                )
+
+        users = query.order_by(sort_column.desc().nullslast(), User.user_id.desc()).limit(limit + 1).all()
+        next_cursor = encode_cursor(users[limit - 1], sort_column) if len(users) > limit else None
+        return users[:limit], next_cursor
+    except Exception as e:
+        logger.error(f"Ошибка при получении страницы пользователей: {e}")
+        return [], None
     finally:
         session.close()
 
 def log_admin_action(admin_id, action, target_user_id=None, details=None):
+    """Постановка записи журнала в буфер, в базу ее пишет flush_admin_logs"""
+    _admin_log_buffer.append({
+        'admin_id': admin_id,
+        'action': action,
+        'target_user_id': target_user_id,
+        'details': details,
+        'timestamp': moscow_now()
+    })
+    # Без JobQueue (или при переполнении буфера) сбрасываем сразу
+    if not _scheduler['job_queue'] or len(_admin_log_buffer) >= ADMIN_LOG_BUFFER_LIMIT:
+        flush_admin_logs()
+
+@metrics.timed('bot_db_seconds', op='flush_admin_logs')
+def flush_admin_logs():
+    """Запись накопленных действий в базу одним пакетным INSERT"""
+    with _admin_log_flush_lock:
+        entries = []
+        while _admin_log_buffer:
+            entries.append(_admin_log_buffer.popleft())
+        if not entries:
+            return 0
+
+        session = Session()
+        try:
+            session.bulk_insert_mappings(AdminLog, entries)
+            session.commit()
+            return len(entries)
+        except Exception as e:
+            logger.error(f"Ошибка при логировании действия: {e}")
+            session.rollback()
+            # Возвращаем записи в начало буфера для следующей попытки
+            _admin_log_buffer.extendleft(reversed(entries))
+            return 0
+        finally:
+            session.close()
+
+def admin_logs_query(session, filters_):
+    """Запрос журнала с фильтрами по пользователю, действию и диапазону дат"""
+    query = session.query(AdminLog)
+    if filters_.get('user'):
+        query = query.filter(AdminLog.target_user_id == filters_['user'])
+    if filters_.get('action'):
+        query = query.filter(AdminLog.action == filters_['action'])
+    if filters_.get('date_from'):
+        query = query.filter(AdminLog.timestamp >= filters_['date_from'])
+    if filters_.get('date_to'):
+        query = query.filter(AdminLog.timestamp < filters_['date_to'] + timedelta(days=1))
+    return query
+
+@metrics.timed('bot_db_seconds', op='get_admin_logs_page')
+def get_admin_logs_page(filters_, cursor=None, limit=ADMIN_LOG_PAGE_SIZE):
+    """Страница журнала от новых к старым (курсор - ID последней записи), возвращает (записи, курсор)"""
+    flush_admin_logs()
     session = Session()
     try:
-        log = AdminLog(
-            admin_id=admin_id,
-            action=action,
-            target_user_id=target_user_id,
-            details=details,
-            timestamp=datetime.now(MOSCOW_TZ)
-        )
-        session.add(log)
+        query = admin_logs_query(session, filters_)
+        if cursor:
+            query = query.filter(AdminLog.id < int(cursor))
+        logs = query.order_by(AdminLog.id.desc()).limit(limit + 1).all()
+        next_cursor = str(logs[limit - 1].id) if len(logs) > limit else None
+        return logs[:limit], next_cursor
+    except Exception as e:
+        logger.error(f"Ошибка при получении логов: {e}")
+        return [], None
+    finally:
+        session.close()
+
+def admin_log_rows(filters_):
+    """Ленивая выборка журнала для CSV, читает базу порциями"""
+    flush_admin_logs()
+    session = Session()
+    try:
+        query = admin_logs_query(session, filters_).order_by(AdminLog.id.desc()).yield_per(1000)
+        for log in query:
+            yield [
+                log.timestamp.strftime('%d.%m.%Y %H:%M:%S') if log.timestamp else '',
+                log.admin_id,
+                log.action,
+                log.target_user_id or '',
+                log.details or ''
+            ]
+    finally:
+        session.close()
+
+@metrics.timed('bot_db_seconds', op='compact_admin_logs')
+def compact_admin_logs(retention_days=ADMIN_LOG_RETENTION_DAYS):
+    """Свертка записей старше срока хранения в дневные итоги, возвращает число удаленных записей"""
+    cutoff = datetime.combine(moscow_now().date() - timedelta(days=retention_days), datetime.min.time())
+    session = Session()
+    try:
+        day = func.date(AdminLog.timestamp)
+        totals = session.query(day, AdminLog.action, func.count(AdminLog.id)).filter(
+            AdminLog.timestamp < cutoff
+        ).group_by(day, AdminLog.action).all()
+        if not totals:
+            return 0
+
+        for day_value, action, count in totals:
+            # SQLite возвращает date() строкой
+            if isinstance(day_value, str):
+                day_value = datetime.strptime(day_value, '%Y-%m-%d').date()
+            daily = session.get(AdminLogDaily, (day_value, action or ''))
+            if daily:
+                daily.count += count
+            else:
+                session.add(AdminLogDaily(day=day_value, action=action or '', count=count))
+
+        removed = session.query(AdminLog).filter(AdminLog.timestamp < cutoff).delete(synchronize_session=False)
         session.commit()
+        return removed
     except Exception as e:
-        logger.error(f"Ошибка при логировании действия: {e}")
+        logger.error(f"Ошибка при свертке журнала действий: {e}")
         session.rollback()
+        return 0
     finally:
         session.close()
 
@@ -245,14 +926,555 @@ def is_user_allowed(user_id):
         return False
     
     if user.is_blocked:
-        if user.block_until:
-            if datetime.now(MOSCOW_TZ) > user.block_until:
-                unblock_user(user_id)
-                return user.is_approved
+        # Блокировку снимает block_expiry_job; до его срабатывания истекший срок просто не учитываем
+        if user.block_until and moscow_now() >= user.block_until:
+            return user.is_approved
         return False
     
     return user.is_approved
 
+class SchemaValidationError(Exception):
+    """Структура файла остатков не соответствует схеме листа"""
+
+def load_sheet_schema():
+    """Схема листа по умолчанию с переопределениями из SHEET_SCHEMA (JSON)"""
+    schema = json.loads(json.dumps(DEFAULT_SHEET_SCHEMA))
+    override = os.environ.get('SHEET_SCHEMA')
+    if not override:
+        return schema
+
+    try:
+        custom = json.loads(override)
+        for key, spec in custom.pop('columns', {}).items():
+            schema['columns'].setdefault(key, {}).update(spec)
+        schema.update(custom)
+        for key in ('name', 'info_c', 'info_d', 'reserve', 'available'):
+            if 'column' not in schema['columns'].get(key, {}):
+                raise ValueError(f"для столбца '{key}' не задана позиция column")
+    except (ValueError, AttributeError) as e:
+        logger.error(f"❌ Некорректная схема листа в SHEET_SCHEMA, используется схема по умолчанию: {e}")
+        return json.loads(json.dumps(DEFAULT_SHEET_SCHEMA))
+    return schema
+
+def load_data_sources():
+    """Список источников данных по складам с настройками FTP по умолчанию"""
+    ftp_defaults = {
+        'host': FTP_HOST,
+        'port': FTP_PORT,
+        'username': FTP_USERNAME,
+        'password': FTP_PASSWORD,
+        'path': FTP_PATH
+    }
+    default_sources = [{
+        'warehouse': WAREHOUSE_NAME,
+        'type': 'ftp',
+        'filename': FTP_FILENAME,
+        'fallback': LOCAL_FILENAME
+    }]
+
+    sources = default_sources
+    if DATA_SOURCES:
+        try:
+            sources = json.loads(DATA_SOURCES)
+            if not isinstance(sources, list) or not sources:
+                raise ValueError("ожидается непустой список источников")
+            for source in sources:
+                if not source.get('warehouse') or not source.get('filename'):
+                    raise ValueError(f"у источника не указан склад или файл: {source}")
+                if source.get('type', 'ftp') not in ('ftp', 'local'):
+                    raise ValueError(f"неизвестный тип источника: {source.get('type')}")
+            if len({source['warehouse'] for source in sources}) != len(sources):
+                raise ValueError("названия складов должны быть уникальными")
+        except (ValueError, AttributeError) as e:
+            logger.error(f"❌ Некорректный список источников в DATA_SOURCES, используется FTP по умолчанию: {e}")
+            sources = default_sources
+
+    result = []
+    for source in sources:
+        source = dict(source)
+        source.setdefault('type', 'ftp')
+        if source['type'] == 'ftp':
+            for key, value in ftp_defaults.items():
+                source.setdefault(key, value)
+        result.append(source)
+    return result
+
+# Бинарный снимок каталога: заголовок, JSON с метаданными, таблица записей фиксированной
+# ширины, куча строк (названия и доп. информация), куча названий в нижнем регистре для поиска,
+# матрица поставок, индекс, отсортированный по названию, и индекс поставок по дате (дата, товар,
+# количество) для выборок по диапазону дат. Файл открывается через mmap,
+# товары декодируются только при обращении к ним
+CATALOG_MAGIC = b'STKCAT03'
+CATALOG_HEADER = struct.Struct('<8sIIQQQQQQQQQQQQ')
+CATALOG_ALIGN = 8
+
+def _catalog_record(warehouse_count):
+    """Запись товара: смещения строк, остатки, маска складов и остатки по складам"""
+    return struct.Struct('<IIIIddI' + 'dd' * warehouse_count)
+
+def _catalog_date(value):
+    return value.isoformat() if value else None
+
+def _catalog_parse_date(value):
+    return datetime.fromisoformat(value) if value else None
+
+def build_aggregates(shipment_dates, products):
+    """Сводка по каталогу, считается один раз при сборке снимка: нули, разделы, поставки по датам, топ резерва"""
+    zero_stock = 0
+    low_stock = 0
+    collections = {}
+    shipments = {date_info['display_date']: 0.0 for date_info in shipment_dates}
+    for product in products:
+        available = product['available']
+        if available <= 0:
+            zero_stock += 1
+        elif available <= LOW_STOCK_THRESHOLD:
+            low_stock += 1
+
+        totals = collections.setdefault(product.get('collection') or '', [0, 0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += available <= 0
+        totals[2] += product['reserve']
+        totals[3] += available
+
+        for date_display, quantity in product['shipments'].items():
+            shipments[date_display] += quantity
+
+    # 'Более 200' (201) в суммах считается как 201 - для сводки этого достаточно
+    top_reserved = heapq.nlargest(
+        DASHBOARD_TOP_N,
+        ((product['reserve'], idx) for idx, product in enumerate(products) if product['reserve'] > 0)
+    )
+    return {
+        'products': len(products),
+        'zero_stock': zero_stock,
+        'low_stock': low_stock,
+        'collections': [[name] + totals for name, totals in collections.items()],
+        'shipments': [[date_display, quantity] for date_display, quantity in shipments.items()],
+        'top_reserved': [[idx, reserve] for reserve, idx in top_reserved]
+    }
+
+def build_catalog(shipment_dates, products, warehouses, sources=None, state=None):
+    """Сборка бинарного снимка каталога из списка товаров, возвращает bytes"""
+    warehouse_ids = {warehouse: idx for idx, warehouse in enumerate(warehouses)}
+    date_ids = {date_info['display_date']: idx for idx, date_info in enumerate(shipment_dates)}
+    record = _catalog_record(len(warehouses))
+    columns = (1 + len(warehouses)) * len(shipment_dates)
+    matrix_row = struct.Struct(f'<{columns}d')
+
+    collections = []
+    collection_ids = {}
+    strings = bytearray()
+    names = bytearray(b'\n')
+    records = bytearray()
+    matrix = bytearray()
+    starts = []
+    keys = []
+    key_bounds = []
+    collection_column = []
+    # Поставки всех товаров: (день по григорианскому календарю, номер товара, количество)
+    arrivals = []
+    date_ordinals = [date_info['date'].toordinal() for date_info in shipment_dates]
+
+    def add_string(value):
+        data = (value or '').encode('utf-8')
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    for idx, product in enumerate(products):
+        name_off, name_len = add_string(product['name'])
+        info_off, info_len = add_string(product['additional_info'])
+
+        # Разделитель названий - перевод строки, поэтому внутри названия его быть не должно
+        lower = product['name'].lower().replace('\n', ' ')
+        lower_bytes = lower.encode('utf-8')
+        low_off = len(names)
+        key = lower.strip().encode('utf-8')
+        key_off = low_off + len(lower[:len(lower) - len(lower.lstrip())].encode('utf-8'))
+        names.extend(lower_bytes)
+        names.extend(b'\n')
+        starts.append(low_off)
+        keys.append((key, idx))
+        key_bounds.append((key_off, key_off + len(key)))
+
+        collection = product.get('collection')
+        if collection:
+            collection_id = collection_ids.get(collection)
+            if collection_id is None:
+                collection_id = collection_ids[collection] = len(collections)
+                collections.append([collection, []])
+            collections[collection_id][1].append(idx)
+        else:
+            collection_id = -1
+        collection_column.append(collection_id)
+
+        stocks = product.get('warehouses') or {}
+        presence = 0
+        per_warehouse = [0.0] * (2 * len(warehouses))
+        quantities = [float('nan')] * columns
+        for date_display, quantity in product['shipments'].items():
+            quantities[date_ids[date_display]] = quantity
+            arrivals.append((date_ordinals[date_ids[date_display]], idx, quantity))
+        for warehouse, stock in stocks.items():
+            warehouse_id = warehouse_ids[warehouse]
+            presence |= 1 << warehouse_id
+            per_warehouse[2 * warehouse_id] = stock['reserve']
+            per_warehouse[2 * warehouse_id + 1] = stock['available']
+            base = (1 + warehouse_id) * len(shipment_dates)
+            for date_display, quantity in stock['shipments'].items():
+                quantities[base + date_ids[date_display]] = quantity
+
+        records.extend(record.pack(
+            name_off, name_len, info_off, info_len,
+            product['reserve'], product['available'], presence, *per_warehouse
+        ))
+        matrix.extend(matrix_row.pack(*quantities))
+
+    keys.sort()
+    arrivals.sort()
+    meta = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'warehouses': list(warehouses),
+        'shipment_dates': [
+            {'date': _catalog_date(date_info['date']), 'display_date': date_info['display_date']}
+            for date_info in shipment_dates
+        ],
+        'collections': collections,
+        'aggregates': build_aggregates(shipment_dates, products),
+        'sources': sources or {},
+        'state': state or {}
+    }, ensure_ascii=False).encode('utf-8')
+
+    # Секции выравниваются, чтобы массивы индексов читались через memoryview.cast
+    # Отсортированный индекс: номера товаров и границы их ключей в куче названий
+    sorted_index = array('I')
+    for _, idx in keys:
+        sorted_index.append(idx)
+    for key, idx in keys:
+        sorted_index.append(key_bounds[idx][0])
+        sorted_index.append(key_bounds[idx][1])
+    # Индекс поставок - три подряд идущих массива: даты, номера товаров и количества
+    arrival_index = (array('I', [arrival[0] for arrival in arrivals]).tobytes()
+                     + array('I', [arrival[1] for arrival in arrivals]).tobytes()
+                     + array('d', [arrival[2] for arrival in arrivals]).tobytes())
+    sections = [meta, bytes(records), bytes(strings), bytes(names), bytes(matrix),
+                array('I', starts).tobytes(), sorted_index.tobytes(), array('i', collection_column).tobytes(),
+                arrival_index]
+    body = bytearray()
+    offsets = []
+    position = CATALOG_HEADER.size
+    for section in sections:
+        padding = -position % CATALOG_ALIGN
+        body.extend(b'\0' * padding)
+        position += padding
+        offsets.append(position)
+        body.extend(section)
+        position += len(section)
+
+    header = CATALOG_HEADER.pack(
+        CATALOG_MAGIC, len(products), len(warehouses), offsets[0], len(meta),
+        offsets[1], offsets[2], offsets[3], len(names), offsets[4], offsets[5], offsets[6], offsets[7],
+        offsets[8], len(arrivals)
+    )
+    return header + bytes(body)
+
+def write_catalog_file(path, data):
+    """Атомарная запись снимка: временный файл в той же папке и os.replace"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def _needles_pattern(needles):
+    """Регулярное выражение, совпадающее с любой из подстрок (bytes). Подстроки собраны
+    в префиксное дерево, поэтому в каждой позиции проверяется одна ветка, а не все подстроки"""
+    trie = {}
+    for needle in needles:
+        node = trie
+        for byte in needle:
+            node = node.setdefault(byte, {})
+        node[None] = {}
+
+    def build(node):
+        parts = []
+        # Цепочку узлов с единственным продолжением записываем одной строкой без групп
+        while len(node) == 1 and None not in node:
+            (byte, node), = node.items()
+            parts.append(re.escape(bytes([byte])))
+        branches = [re.escape(bytes([byte])) + build(child) for byte, child in node.items() if byte is not None]
+        if branches:
+            tail = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+            parts.append(b'(?:' + tail + b')?' if None in node else tail)
+        return b''.join(parts)
+
+    return re.compile(build(trie))
+
+class CollectionIndices(list):
+    """Номера товаров раздела вместе с номером раздела в снимке
+    и участками кучи названий (начало, конец), где лежат названия его товаров"""
+
+    def __init__(self, collection_id, indices, ranges):
+        super().__init__(indices)
+        self.collection_id = collection_id
+        self.ranges = ranges
+
+class CatalogProducts(Sequence):
+    """Список товаров поверх снимка: словарь товара собирается при обращении"""
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+
+    def __len__(self):
+        return self._catalog.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._catalog.product(i) for i in range(*idx.indices(self._catalog.count))]
+        if idx < 0:
+            idx += self._catalog.count
+        if not 0 <= idx < self._catalog.count:
+            raise IndexError(idx)
+        return self._catalog.product(idx)
+
+class MappedCatalog:
+    """Снимок каталога в mmap (или в памяти, если файл записать не удалось)"""
+
+    def __init__(self, buffer):
+        self._buf = buffer
+        (magic, self.count, warehouse_count, meta_off, meta_len, self._records_off, self._strings_off,
+         self._names_off, self._names_len, self._matrix_off, starts_off, sorted_off,
+         collections_off, arrivals_off, self.arrival_count) = CATALOG_HEADER.unpack_from(buffer, 0)
+        if magic != CATALOG_MAGIC:
+            raise ValueError("Неизвестный формат снимка каталога")
+
+        self.meta = json.loads(bytes(buffer[meta_off:meta_off + meta_len]).decode('utf-8'))
+        self.warehouses = self.meta['warehouses']
+        self.shipment_dates = [
+            {'date': _catalog_parse_date(date_info['date']), 'display_date': date_info['display_date']}
+            for date_info in self.meta['shipment_dates']
+        ]
+        self._display_dates = [date_info['display_date'] for date_info in self.shipment_dates]
+        self._date_ordinals = [date_info['date'].toordinal() for date_info in self.shipment_dates]
+        self._record = _catalog_record(warehouse_count)
+        self._matrix_row = struct.Struct(f'<{(1 + warehouse_count) * len(self.shipment_dates)}d')
+
+        view = memoryview(buffer)
+        self._starts = view[starts_off:starts_off + 4 * self.count].cast('I')
+        self._sorted = view[sorted_off:sorted_off + 4 * self.count].cast('I')
+        self._key_bounds = view[sorted_off + 4 * self.count:sorted_off + 12 * self.count].cast('I')
+        self._collection_ids = view[collections_off:collections_off + 4 * self.count].cast('i')
+        arrival_count = self.arrival_count
+        self._arrival_dates = view[arrivals_off:arrivals_off + 4 * arrival_count].cast('I')
+        self._arrival_products = view[arrivals_off + 4 * arrival_count:arrivals_off + 8 * arrival_count].cast('I')
+        self._arrival_quantities = view[arrivals_off + 8 * arrival_count:arrivals_off + 16 * arrival_count].cast('d')
+
+        # Разделы каталога: ключ в нижнем регистре -> (название, номера товаров)
+        self.collection_names = [name for name, _ in self.meta['collections']]
+        self.collections = {
+            name.lower(): (name, CollectionIndices(collection_id, indices, self._heap_ranges(indices)))
+            for collection_id, (name, indices) in enumerate(self.meta['collections'])
+        }
+        self.aggregates = self.meta['aggregates']
+        # Готовые (уже экранированные) карточки товаров, заполняются при первом показе товара
+        self.cards = {}
+        self.products = CatalogProducts(self)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            # Отображение остается валидным и после закрытия файла и его замены новым снимком
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def empty(cls):
+        return cls(build_catalog([], [], []))
+
+    def _fields(self, idx):
+        return self._record.unpack_from(self._buf, self._records_off + idx * self._record.size)
+
+    def _string(self, offset, length):
+        start = self._strings_off + offset
+        return self._buf[start:start + length].decode('utf-8')
+
+    def _heap_ranges(self, indices):
+        """Участки кучи названий для возрастающих номеров товаров: подряд идущие товары - один участок"""
+        ranges = []
+        for idx in indices:
+            start = self._starts[idx]
+            end = self._starts[idx + 1] if idx + 1 < self.count else self._names_len
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def _sorted_key(self, position):
+        """Ключ точного поиска (название без пробелов по краям) n-го товара в отсортированном индексе"""
+        start, end = self._key_bounds[2 * position], self._key_bounds[2 * position + 1]
+        return self._buf[self._names_off + start:self._names_off + end]
+
+    def product(self, idx):
+        """Словарь товара в том же виде, что и при разборе файла"""
+        fields = self._fields(idx)
+        quantities = self._matrix_row.unpack_from(self._buf, self._matrix_off + idx * self._matrix_row.size)
+        dates = self._display_dates
+        date_count = len(dates)
+
+        def shipments(base):
+            # NaN - поставки на эту дату нет
+            return {date: quantity for date, quantity in zip(dates, quantities[base:base + date_count]) if quantity == quantity}
+
+        presence = fields[6]
+        warehouses = {}
+        for warehouse_id, warehouse in enumerate(self.warehouses):
+            if presence & (1 << warehouse_id):
+                warehouses[warehouse] = {
+                    'reserve': fields[7 + 2 * warehouse_id],
+                    'available': fields[8 + 2 * warehouse_id],
+                    'shipments': shipments((1 + warehouse_id) * date_count)
+                }
+
+        collection_id = self._collection_ids[idx]
+        return {
+            'name': self._string(fields[0], fields[1]),
+            'additional_info': self._string(fields[2], fields[3]),
+            'collection': self.collection_names[collection_id] if collection_id >= 0 else None,
+            'reserve': fields[4],
+            'available': fields[5],
+            'shipments': shipments(0),
+            'warehouses': warehouses
+        }
+
+    def find(self, term_lower, scope=None):
+        """Номера товаров, в названии которых есть подстрока (поиск по куче названий через find).
+        С разделом просматриваются только участки кучи с названиями его товаров"""
+        needle = term_lower.replace('\n', ' ').encode('utf-8')
+        if not needle:
+            return list(scope) if scope is not None else list(range(self.count))
+        ranges = scope.ranges if scope is not None else [(0, self._names_len)]
+
+        found = []
+        for range_start, range_end in ranges:
+            position = self._names_off + range_start
+            end = self._names_off + range_end
+            while True:
+                position = self._buf.find(needle, position, end)
+                if position < 0:
+                    break
+                idx = bisect_right(self._starts, position - self._names_off) - 1
+                found.append(idx)
+                # Следующее совпадение ищем уже в следующем товаре
+                position = self._names_off + self._starts[idx + 1] if idx + 1 < self.count else end
+        return found
+
+    def find_many(self, terms_lower):
+        """Номера товаров сразу для нескольких подстрок за один проход по куче названий:
+        общее выражение находит ближайшее название хотя бы с одной подстрокой,
+        и это название проверяется на все подстроки сразу"""
+        found = {term: [] for term in terms_lower}
+        needles = {}
+        for term in found:
+            needle = term.replace('\n', ' ').encode('utf-8')
+            if needle:
+                needles[term] = needle
+            else:
+                found[term] = list(range(self.count))
+        if not needles:
+            return found
+
+        pattern = _needles_pattern(set(needles.values()))
+        position = self._names_off
+        end = self._names_off + self._names_len
+        while True:
+            match = pattern.search(self._buf, position, end)
+            if match is None:
+                return found
+            idx = bisect_right(self._starts, match.start() - self._names_off) - 1
+            # Следующее совпадение ищем уже в следующем товаре
+            position = self._names_off + self._starts[idx + 1] if idx + 1 < self.count else end
+            name = self._buf[self._names_off + self._starts[idx]:position]
+            for term, needle in needles.items():
+                if needle in name:
+                    found[term].append(idx)
+
+    def in_collection(self, idx, scope):
+        """Товар входит в раздел scope (CollectionIndices)"""
+        return self._collection_ids[idx] == scope.collection_id
+
+    def find_exact(self, term_lower):
+        """Номера товаров с точно таким названием (двоичный поиск по отсортированному индексу)"""
+        key = term_lower.strip().encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._sorted_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < self.count and self._sorted_key(low) == key:
+            found.append(self._sorted[low])
+            low += 1
+        return found
+
+    def arrival_range(self, start, end):
+        """Позиции индекса поставок с датой от start до end включительно (двоичный поиск)"""
+        low = bisect_left(self._arrival_dates, start.toordinal())
+        high = bisect_right(self._arrival_dates, end.toordinal(), low)
+        return range(low, high)
+
+    def arrival(self, position):
+        """Поставка из индекса: (дата, номер товара, количество)"""
+        return (
+            datetime.fromordinal(self._arrival_dates[position]),
+            self._arrival_products[position],
+            self._arrival_quantities[position]
+        )
+
+    def next_arrival(self, idx, since):
+        """Ближайшая поставка товара не раньше since: (дата, количество) или None"""
+        quantities = self._matrix_row.unpack_from(self._buf, self._matrix_off + idx * self._matrix_row.size)
+        # Даты снимка отсортированы - начинаем с первой не раньше since
+        first = bisect_left(self._date_ordinals, since.toordinal())
+        for position in range(first, len(self.shipment_dates)):
+            if quantities[position] == quantities[position]:
+                return self.shipment_dates[position]['date'], quantities[position]
+        return None
+
+    def source_snapshot(self, warehouse):
+        """Данные одного склада в виде результата загрузки его файла (для повторного объединения)"""
+        warehouse_id = self.warehouses.index(warehouse)
+        products = []
+        for idx in range(self.count):
+            if not self._fields(idx)[6] & (1 << warehouse_id):
+                continue
+            product = self.product(idx)
+            stock = product['warehouses'][warehouse]
+            products.append({
+                'name': product['name'],
+                'additional_info': product['additional_info'],
+                'collection': product['collection'],
+                'reserve': stock['reserve'],
+                'available': stock['available'],
+                'shipments': stock['shipments']
+            })
+
+        source = self.meta['sources'].get(warehouse, {})
+        dates_used = set(source.get('shipment_dates', []))
+        return {
+            'shipment_dates': [date_info for date_info in self.shipment_dates if date_info['display_date'] in dates_used],
+            'products': products,
+            'file_modify_time': _catalog_parse_date(source.get('file_modify_time')),
+            'data_source': source.get('data_source', '')
+        }
+
 class StockBot:
     def __init__(self):
         self.products = []
@@ -262,206 +1484,569 @@ class StockBot:
         self.file_modify_time = None
         self.auto_update_enabled = True
         self.last_auto_update = None
-        
+        self.schema = load_sheet_schema()
+        self.sources = load_data_sources()
+        # Только что загруженные данные складов, еще не вошедшие в снимок каталога;
+        # данные остальных складов берутся из самого снимка
+        self.source_snapshots = {}
+        # Ошибки проверки структуры файла по складам
+        self._schema_errors = {}
+        self.schema_error_notified = None
+        # Время изменения общего снимка, из которого загружен каталог (экземпляры без обновления)
+        self.shared_snapshot_mtime = None
+        self._lock = threading.Lock()
+        # Снимок каталога (mmap), заменяется целиком при каждой загрузке
+        self.catalog = MappedCatalog.empty()
+
+    def _apply_catalog(self, catalog):
+        """Атомарная замена снимка каталога: поиск и выдача товаров сразу идут по новому снимку"""
+        self.catalog = catalog
+        self.shipment_dates = catalog.shipment_dates
+        self.products = catalog.products
+
+    def _publish_catalog(self, shipment_dates, products, sources):
+        """Запись снимка в SNAPSHOT_PATH и его отображение; без записи на диск - снимок в памяти"""
+        data = build_catalog(
+            shipment_dates, products, [source['warehouse'] for source in self.sources],
+            sources=sources, state=self._catalog_state()
+        )
+        # Общий снимок публикует только обновляющий экземпляр
+        if not SHARED_DIR or is_refresh_leader():
+            try:
+                write_catalog_file(SNAPSHOT_PATH, data)
+                return MappedCatalog.from_file(SNAPSHOT_PATH)
+            except OSError as e:
+                logger.warning(f"⚠️ Снимок каталога не записан ({e}), используется копия в памяти")
+        return MappedCatalog(data)
+
+    def _catalog_state(self):
+        return {
+            'auto_update_enabled': self.auto_update_enabled,
+            'last_auto_update': _catalog_date(self.last_auto_update),
+            'last_update': _catalog_date(self.last_update),
+            'scheduler': update_scheduler.to_state()
+        }
+
+    def _has_source(self, warehouse):
+        """Есть ли у склада данные - свежие или в текущем снимке"""
+        return warehouse in self.source_snapshots or warehouse in self.catalog.meta['sources']
+
+    def _update_source_info(self, sources):
+        """Время файла и подпись источника по метаданным складов"""
+        if not sources:
+            return
+        self.file_modify_time = max(_catalog_parse_date(source['file_modify_time']) for source in sources.values())
+        if len(sources) == 1:
+            self.data_source = next(iter(sources.values()))['data_source']
+        else:
+            self.data_source = ", ".join(f"{warehouse}: {source['data_source']}" for warehouse, source in sources.items())
+
+    @property
+    def schema_error(self):
+        """Текст ошибок проверки структуры файлов (None - все файлы в порядке)"""
+        errors = dict(self._schema_errors)
+        if not errors:
+            return None
+        return "; ".join(f"{warehouse}: {error}" for warehouse, error in errors.items())
+
+    def warehouses_title(self):
+        """'Склад Санкт-Петербург' или 'Склады Санкт-Петербург, Москва'"""
+        names = [source['warehouse'] for source in self.sources]
+        return f"Склад {names[0]}" if len(names) == 1 else f"Склады {', '.join(names)}"
+
     def load_data(self):
         """Загрузка данных - сначала пробуем FTP, потом локальный файл"""
-        # Пробуем загрузить с FTP
-        if self.download_file_from_ftp():
-            self.data_source = "FTP сервер"
-            return True
-        
-        # Если FTP не сработал, пробуем локальный файл
-        if self.load_local_file():
-            self.data_source = "Локальный файл"
-            return True
-            
-        return False
-        
-    def download_file_from_ftp(self):
-        """Загрузка файла с FTP сервера"""
-        try:
-            ftp = ftplib.FTP()
-            ftp.connect(FTP_HOST, FTP_PORT)
-            ftp.login(FTP_USERNAME, FTP_PASSWORD)
-            
-            try:
-                ftp.cwd(FTP_PATH)
-            except:
-                logger.warning(f"Не удалось перейти в папку {FTP_PATH}, пробуем корневую")
+        return self.refresh_sources(use_fallback=True)
+
+    @metrics.timed('stock_refresh_seconds')
+    def refresh_sources(self, use_fallback=True, sources=None):
+        """Параллельная загрузка складов (по умолчанию всех); медленный источник не задерживает остальные"""
+        sources = sources or self.sources
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='source')
+        futures = {executor.submit(self._load_source, source, use_fallback): source for source in sources}
+        done, not_done = wait(futures, timeout=SOURCE_TIMEOUT)
+        executor.shutdown(wait=False)
+
+        loaded = sum(1 for future in done if self._store_source_result(futures[future], future))
+
+        for future in not_done:
+            source = futures[future]
+            logger.warning(
+                f"⏳ Склад {source['warehouse']}: источник не ответил за {SOURCE_TIMEOUT} с, "
+                f"пока используются предыдущие данные"
+            )
+            # Когда источник все-таки загрузится, его данные попадут в каталог
+            future.add_done_callback(
+                lambda f, source=source: self._store_source_result(source, f) and self._merge_sources()
+            )
+
+        if loaded:
+            self._merge_sources()
+        return loaded > 0
+
+    def _store_source_result(self, source, future):
+        """Сохраняет результат загрузки склада, если она была успешной"""
+        snapshot = future.result()
+        if not snapshot:
+            return False
+        with self._lock:
+            self.source_snapshots[source['warehouse']] = snapshot
+        return True
+
+    def _load_source(self, source, use_fallback=True):
+        """Загрузка и разбор файла одного склада (выполняется в отдельном потоке)"""
+        warehouse = source['warehouse']
+        attempts = [(source['type'], source)]
+        if use_fallback and source['type'] == 'ftp' and source.get('fallback'):
+            attempts.append(('local', {'filename': source['fallback']}))
+
+        for source_type, target in attempts:
+            try:
+                if source_type == 'ftp':
+                    file_data, file_modify_time = self.download_file_from_ftp(target)
+                else:
+                    file_data, file_modify_time = self.load_local_file(target['filename'])
+                with metrics.timer('stock_refresh_stage_seconds', stage='parse'):
+                    shipment_dates, products = self._read_workbook(file_data)
+
+            except SchemaValidationError as e:
+                metrics.inc('stock_refresh_total', warehouse=warehouse, result='schema_error')
+                self._schema_errors[warehouse] = str(e)
+                logger.error(f"❌ Склад {warehouse}: файл не прошел проверку структуры: {e}")
+                # Файл сломан - оставляем текущие данные склада, а не подменяем их
+                # устаревшим локальным файлом
+                if self._has_source(warehouse):
+                    return None
+                continue
+            except Exception as e:
+                metrics.inc('stock_refresh_total', warehouse=warehouse, result='error')
+                label = "с FTP" if source_type == 'ftp' else "локального файла"
+                logger.error(f"Ошибка при загрузке {label} (склад {warehouse}): {e}")
+                continue
+
+            self._schema_errors.pop(warehouse, None)
+            metrics.inc('stock_refresh_total', warehouse=warehouse, result='ok')
+            data_source = "FTP сервер" if source_type == 'ftp' else "Локальный файл"
+            logger.info(
+                f"Склад {warehouse}: файл загружен ({data_source}). "
+                f"Найдено {len(products)} товаров и {len(shipment_dates)} дат поставок"
+            )
+            return {
+                'shipment_dates': shipment_dates,
+                'products': products,
+                'file_modify_time': file_modify_time,
+                'data_source': data_source
+            }
+
+        return None
+
+    @staticmethod
+    def _add_quantity(total, value):
+        """Сумма количеств по складам; 'Более 200' (201) на любом складе дает 'Более 200'"""
+        if total == 201 or value == 201:
+            return 201
+        return total + value
+
+    @metrics.timed('stock_refresh_stage_seconds', stage='merge')
+    def _merge_sources(self):
+        """Объединение данных всех складов в один каталог по артикулу"""
+        with self._lock:
+            # Склады без новой загрузки берутся из текущего снимка
+            snapshots = []
+            for source in self.sources:
+                warehouse = source['warehouse']
+                if warehouse in self.source_snapshots:
+                    snapshots.append((warehouse, self.source_snapshots[warehouse]))
+                elif warehouse in self.catalog.meta['sources']:
+                    snapshots.append((warehouse, self.catalog.source_snapshot(warehouse)))
+            if not snapshots:
+                return
+
+            merged = {}
+            shipment_dates = {}
+            for warehouse, snapshot in snapshots:
+                for date_info in snapshot['shipment_dates']:
+                    shipment_dates.setdefault(date_info['display_date'], {
+                        'date': date_info['date'],
+                        'display_date': date_info['display_date']
+                    })
+
+                # Повторяющиеся названия внутри файла не схлопываем: n-е вхождение
+                # объединяется с n-м вхождением на других складах
+                occurrences = {}
+                for product in snapshot['products']:
+                    occurrence = occurrences[product['name']] = occurrences.get(product['name'], 0) + 1
+                    key = (product['name'], occurrence)
+
+                    item = merged.get(key)
+                    if item is None:
+                        item = merged[key] = {
+                            'name': product['name'],
+                            'additional_info': product['additional_info'],
+                            'collection': product['collection'],
+                            'reserve': 0,
+                            'available': 0,
+                            'shipments': {},
+                            'warehouses': {}
+                        }
+                    item['additional_info'] = item['additional_info'] or product['additional_info']
+                    item['collection'] = item['collection'] or product['collection']
+                    item['warehouses'][warehouse] = {
+                        'reserve': product['reserve'],
+                        'available': product['available'],
+                        'shipments': product['shipments']
+                    }
+                    item['reserve'] = self._add_quantity(item['reserve'], product['reserve'])
+                    item['available'] = self._add_quantity(item['available'], product['available'])
+                    for date_display, quantity in product['shipments'].items():
+                        item['shipments'][date_display] = self._add_quantity(
+                            item['shipments'].get(date_display, 0), quantity
+                        )
+
+            sources = {
+                warehouse: {
+                    'file_modify_time': _catalog_date(snapshot['file_modify_time']),
+                    'data_source': snapshot['data_source'].replace(RESTORED_SUFFIX, ''),
+                    'shipment_dates': [date_info['display_date'] for date_info in snapshot['shipment_dates']]
+                }
+                for warehouse, snapshot in snapshots
+            }
+            self.last_update = datetime.now(MOSCOW_TZ)
+            catalog = self._publish_catalog(
+                sorted(shipment_dates.values(), key=lambda date_info: date_info['date']),
+                list(merged.values()),
+                sources
+            )
+            self._apply_catalog(catalog)
+            self._update_source_info(sources)
+            # Разобранные товары больше не нужны: все данные складов теперь в снимке
+            self.source_snapshots.clear()
+
+        metrics.set('stock_products', len(self.products))
+        metrics.set('stock_shipment_dates', len(self.shipment_dates))
+        metrics.set('stock_last_update_timestamp', int(time.time()))
+        logger.info(
+            f"Каталог обновлен: {len(self.products)} товаров, {len(self.shipment_dates)} дат поставок, "
+            f"складов: {len(snapshots)}"
+        )
+
+    def save_checkpoint(self, path=SNAPSHOT_PATH):
+        """Перезапись снимка с текущим состоянием автообновления (снимок каталога и есть контрольная точка)"""
+        with self._lock:
+            catalog = self.catalog
+            if not catalog.count:
+                return False
+            data = build_catalog(
+                catalog.shipment_dates, catalog.products, catalog.warehouses,
+                sources=catalog.meta['sources'], state=self._catalog_state()
+            )
+        write_catalog_file(path, data)
+        logger.info(f"💾 Контрольная точка каталога сохранена: {path}")
+        return True
+
+    def restore_checkpoint(self, path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+        """Подключение снимка каталога из файла вместо холодной загрузки (без разбора товаров)"""
+        try:
+            catalog = MappedCatalog.from_file(path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"⚠️ Контрольная точка {path} не прочитана: {e}")
+            return False
+
+        age = time.time() - catalog.meta.get('saved_at', 0)
+        if catalog.meta.get('version') != SNAPSHOT_VERSION or age > max_age:
+            logger.info(f"ℹ️ Контрольная точка устарела ({int(age)} с), выполняется полная загрузка")
+            return False
+
+        # Берем только склады из текущей конфигурации
+        warehouses = [source['warehouse'] for source in self.sources]
+        sources = {
+            warehouse: dict(source, data_source=source['data_source'] + RESTORED_SUFFIX)
+            for warehouse, source in catalog.meta['sources'].items()
+            if warehouse in warehouses
+        }
+        if not sources:
+            return False
+
+        state = catalog.meta.get('state', {})
+        with self._lock:
+            self.source_snapshots.clear()
+            self.auto_update_enabled = state.get('auto_update_enabled', True)
+            self.last_auto_update = _catalog_parse_date(state.get('last_auto_update'))
+            self.last_update = _catalog_parse_date(state.get('last_update'))
+            update_scheduler.load_state(state.get('scheduler', {}))
+            self._apply_catalog(catalog)
+            self._update_source_info(sources)
+        if catalog.warehouses != warehouses:
+            # Состав складов изменился - пересобираем снимок под текущую конфигурацию
+            self._merge_sources()
+        metrics.set('stock_products', len(self.products))
+        logger.info(f"♻️ Каталог восстановлен из контрольной точки ({int(age)} с назад), складов: {len(sources)}")
+        return True
+
+    def sync_shared_snapshot(self):
+        """Загрузка общего снимка, если обновляющий экземпляр опубликовал новый"""
+        try:
+            mtime = os.path.getmtime(SNAPSHOT_PATH)
+        except OSError:
+            return False
+        if mtime == self.shared_snapshot_mtime:
+            return False
+        # Возраст не ограничиваем: свежее общего снимка у этого экземпляра данных нет
+        if not self.restore_checkpoint(max_age=float('inf')):
+            return False
+        self.shared_snapshot_mtime = mtime
+        return True
+
+    def download_file_from_ftp(self, source):
+        """Загрузка файла склада с FTP сервера в память"""
+        ftp = ftplib.FTP(timeout=FTP_TIMEOUT)
+        try:
+            with metrics.timer('stock_refresh_stage_seconds', stage='connect'):
+                ftp.connect(source['host'], int(source['port']))
+                ftp.login(source['username'], source['password'])
+            
+            try:
+                ftp.cwd(source['path'])
+            except:
+                logger.warning(f"Не удалось перейти в папку {source['path']}, пробуем корневую")
             
             # Получаем время модификации файла
             try:
-                file_time = ftp.voidcmd(f"MDTM {FTP_FILENAME}")[4:].strip()
+                with metrics.timer('stock_refresh_stage_seconds', stage='mdtm'):
+                    file_time = ftp.voidcmd(f"MDTM {source['filename']}")[4:].strip()
                 utc_time = datetime.strptime(file_time, '%Y%m%d%H%M%S')
-                self.file_modify_time = utc_time.replace(tzinfo=pytz.utc).astimezone(MOSCOW_TZ)
+                file_modify_time = utc_time.replace(tzinfo=pytz.utc).astimezone(MOSCOW_TZ)
             except:
                 logger.warning("Не удалось получить время модификации файла с FTP")
-                self.file_modify_time = datetime.now(MOSCOW_TZ)
+                file_modify_time = datetime.now(MOSCOW_TZ)
             
             # Загружаем файл в память
             file_data = io.BytesIO()
-            ftp.retrbinary(f'RETR {FTP_FILENAME}', file_data.write)
+            with metrics.timer('stock_refresh_stage_seconds', stage='download'):
+                ftp.retrbinary(f"RETR {source['filename']}", file_data.write)
             file_data.seek(0)
+            metrics.inc('stock_download_bytes_total', file_data.getbuffer().nbytes)
             
             ftp.quit()
-            
-            # Читаем Excel файл
-            workbook = openpyxl.load_workbook(file_data)
-            sheet = workbook['TDSheet']
-            
-            # Собираем даты поставок из строки 4 (G4-Z4)
-            self.shipment_dates = []
-            for col in range(7, 27):
-                date_cell = sheet.cell(row=4, column=col).value
-                if date_cell and self._parse_date(date_cell):
-                    self.shipment_dates.append({
-                        'column': col,
-                        'date': self._parse_date(date_cell),
-                        'display_date': str(date_cell).strip()
-                    })
-            
-            self.products = []
-            
-            # Парсим данные начиная с 6-й строки
-            for row in range(6, sheet.max_row + 1):
-                product_name = sheet.cell(row=row, column=1).value
-                
-                if not product_name:
-                    continue
-                    
-                product_name_str = str(product_name)
-                skip_keywords = ['Остатки', 'Номенклатура', 'Итого', '2.SPC', '1.UNION', 
-                               '2.Essence', '3.Art', '4.Creative', '4.Подложка', '5.Клей']
-                
-                if any(keyword in product_name_str for keyword in skip_keywords):
-                    continue
-                
-                # Столбец E - В резерве
-                reserve_value = sheet.cell(row=row, column=5).value
-                # Столбец F - Доступно
-                available_value = sheet.cell(row=row, column=6).value
-                
-                # Столбцы C и D - дополнительная информация
-                info_c = sheet.cell(row=row, column=3).value
-                info_d = sheet.cell(row=row, column=4).value
-                additional_info = ""
-                if info_c:
-                    additional_info += str(info_c)
-                if info_d:
-                    if additional_info:
-                        additional_info += " "
-                    additional_info += str(info_d)
-                
-                # Собираем информацию о поставках для этого товара
-                shipments = {}
-                for date_info in self.shipment_dates:
-                    col = date_info['column']
-                    shipment_value = sheet.cell(row=row, column=col).value
-                    if shipment_value and self._parse_value(shipment_value) > 0:
-                        shipments[date_info['display_date']] = self._parse_value(shipment_value)
-                
-                product = {
-                    'name': product_name_str,
-                    'additional_info': additional_info,
-                    'reserve': self._parse_value(reserve_value),
-                    'available': self._parse_value(available_value),
-                    'shipments': shipments
-                }
-                
-                self.products.append(product)
-            
-            self.last_update = datetime.now(MOSCOW_TZ)
-            logger.info(f"Файл успешно загружен с FTP. Найдено {len(self.products)} товаров и {len(self.shipment_dates)} дат поставок")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке файла с FTP: {e}")
-            return False
+            return file_data, file_modify_time
+        finally:
+            ftp.close()
+    
+    def load_local_file(self, filename=LOCAL_FILENAME):
+        """Проверка локального файла, возвращает путь и время модификации"""
+        file_stat = os.stat(filename)
+        utc_time = datetime.fromtimestamp(file_stat.st_mtime)
+        file_modify_time = utc_time.replace(tzinfo=pytz.utc).astimezone(MOSCOW_TZ)
+        return filename, file_modify_time
     
-    def load_local_file(self):
-        """Загрузка локального файла"""
+    @staticmethod
+    def _cell(row, col):
+        """Значение ячейки строки по номеру столбца (с 1)"""
+        return row[col - 1] if col <= len(row) else None
+
+    def _section_name(self, name, has_values=False):
+        """Название раздела, если строка является заголовком раздела каталога"""
+        for keyword in SECTION_KEYWORDS:
+            if keyword in name:
+                return keyword.split('.', 1)[1].strip()
+        # Новые разделы вида '6.Плинтус' узнаем по шаблону, только если в строке нет остатков:
+        # товар с таким названием заголовком не считается
+        if has_values:
+            return None
+        match = SECTION_PATTERN.match(name)
+        if match:
+            return match.group(1).strip()
+        return None
+
+    def _read_workbook(self, source):
+        """Проверка структуры и разбор книги, возвращает (даты поставок, товары)"""
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
         try:
-            if os.path.exists(LOCAL_FILENAME):
-                file_stat = os.stat(LOCAL_FILENAME)
-                utc_time = datetime.fromtimestamp(file_stat.st_mtime)
-                self.file_modify_time = utc_time.replace(tzinfo=pytz.utc).astimezone(MOSCOW_TZ)
+            sheet_name = self.schema['sheet_name']
+            if sheet_name not in workbook.sheetnames:
+                raise SchemaValidationError(f"нет листа '{sheet_name}' (есть: {', '.join(workbook.sheetnames)})")
+
+            sheet = workbook[sheet_name]
+            layout = self._probe_layout(sheet)
+            return self._parse_sheet(sheet, layout)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def _header_key(value):
+        """Текст ячейки заголовка для сравнения с подписью: нижний регистр, одиночные пробелы, без ':' в конце"""
+        return ' '.join(value.lower().split()).rstrip(':').strip()
+
+    def _probe_layout(self, sheet):
+        """Быстрая проверка структуры по первым строкам листа, до полного разбора"""
+        probe_rows = list(sheet.iter_rows(min_row=1, max_row=self.schema['probe_rows'], values_only=True))
+        columns = {}
+        header_rows = []
+        # Подпись сравнивается со всей ячейкой: заголовок отчета 'Остатки и доступность товаров'
+        # в A1 не должен стать столбцом "Доступно"; занятая другим столбцом ячейка пропускается
+        claimed = set()
+
+        for key, spec in self.schema['columns'].items():
+            labels = {self._header_key(label) for label in spec.get('labels', [])}
+            found = None
+            for row_number, row in enumerate(probe_rows, 1):
+                for col, value in enumerate(row, 1):
+                    if (isinstance(value, str) and (row_number, col) not in claimed
+                            and self._header_key(value) in labels):
+                        found = (row_number, col)
+                        break
+                if found:
+                    break
+
+            if found:
+                claimed.add(found)
+                header_rows.append(found[0])
+                columns[key] = found[1]
+            elif labels and spec.get('required'):
+                raise SchemaValidationError(
+                    f"не найден столбец '{spec['labels'][0]}' в первых {len(probe_rows)} строках"
+                )
             else:
-                self.file_modify_time = datetime.now(MOSCOW_TZ)
-            
-            workbook = openpyxl.load_workbook(LOCAL_FILENAME)
-            sheet = workbook['TDSheet']
-            
-            self.shipment_dates = []
-            for col in range(7, 27):
-                date_cell = sheet.cell(row=4, column=col).value
-                if date_cell and self._parse_date(date_cell):
-                    self.shipment_dates.append({
+                columns[key] = spec['column']
+
+        data_columns = [columns['name'], columns['reserve'], columns['available']]
+        if len(set(data_columns)) != len(data_columns):
+            raise SchemaValidationError(f"столбцы названия, резерва и доступности совпадают: {data_columns}")
+
+        # Строка дат поставок - строка заголовка с наибольшим числом дат правее "Доступно"
+        shipment_dates = []
+        dates_row = None
+        for row_number, row in enumerate(probe_rows, 1):
+            row_dates = []
+            for col, value in enumerate(row, 1):
+                if col > columns['available'] and value and self._parse_date(value):
+                    row_dates.append({
                         'column': col,
-                        'date': self._parse_date(date_cell),
-                        'display_date': str(date_cell).strip()
+                        'date': self._parse_date(value),
+                        'display_date': str(value).strip()
                     })
-            
-            self.products = []
-            
-            for row in range(6, sheet.max_row + 1):
-                product_name = sheet.cell(row=row, column=1).value
-                
-                if not product_name:
-                    continue
-                    
-                product_name_str = str(product_name)
-                skip_keywords = ['Остатки', 'Номенклатура', 'Итого', '2.SPC', '1.UNION', 
-                               '2.Essence', '3.Art', '4.Creative', '4.Подложка', '5.Клей']
-                
-                if any(keyword in product_name_str for keyword in skip_keywords):
-                    continue
-                
-                reserve_value = sheet.cell(row=row, column=5).value
-                available_value = sheet.cell(row=row, column=6).value
-                
-                info_c = sheet.cell(row=row, column=3).value
-                info_d = sheet.cell(row=row, column=4).value
-                additional_info = ""
-                if info_c:
-                    additional_info += str(info_c)
-                if info_d:
-                    if additional_info:
-                        additional_info += " "
-                    additional_info += str(info_d)
-                
-                shipments = {}
-                for date_info in self.shipment_dates:
-                    col = date_info['column']
-                    shipment_value = sheet.cell(row=row, column=col).value
-                    if shipment_value and self._parse_value(shipment_value) > 0:
-                        shipments[date_info['display_date']] = self._parse_value(shipment_value)
-                
-                product = {
-                    'name': product_name_str,
-                    'additional_info': additional_info,
-                    'reserve': self._parse_value(reserve_value),
-                    'available': self._parse_value(available_value),
-                    'shipments': shipments
-                }
-                
-                self.products.append(product)
-            
-            self.last_update = datetime.now(MOSCOW_TZ)
-            logger.info(f"Локальный файл загружен. Найдено {len(self.products)} товаров и {len(self.shipment_dates)} дат поставок")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке локального файла: {e}")
-            return False
-    
-    def background_ftp_update(self):
-        """Фоновая загрузка данных с FTP"""
+            if len(row_dates) > len(shipment_dates):
+                shipment_dates = row_dates
+                dates_row = row_number
+        if dates_row:
+            header_rows.append(dates_row)
+
+        if len(shipment_dates) < self.schema['min_shipment_dates']:
+            raise SchemaValidationError(
+                f"найдено {len(shipment_dates)} дат поставок, ожидается не меньше {self.schema['min_shipment_dates']}"
+            )
+
+        # Данные начинаются после строк заголовка, если начало не задано в схеме явно
+        data_start_row = self.schema.get('data_start_row') or (max(header_rows) + 1 if header_rows else 1)
+
+        return {
+            'columns': columns,
+            'shipment_dates': shipment_dates,
+            'data_start_row': data_start_row
+        }
+
+    def _parse_sheet(self, sheet, layout):
+        """Потоковый разбор листа остатков с учетом разделов каталога"""
+        columns = layout['columns']
+        shipment_dates = layout['shipment_dates']
+        products = []
+        current_collection = None
+
+        for row in sheet.iter_rows(min_row=layout['data_start_row'], values_only=True):
+            product_name = self._cell(row, columns['name'])
+
+            if not product_name:
+                continue
+
+            product_name_str = str(product_name)
+
+            # Заголовок раздела - запоминаем, товары ниже относятся к нему
+            has_values = any(
+                self._cell(row, column) not in (None, '')
+                for column in [columns['reserve'], columns['available']] + [date_info['column'] for date_info in shipment_dates]
+            )
+            section = self._section_name(product_name_str, has_values)
+            if section:
+                current_collection = section
+                continue
+
+            if any(keyword in product_name_str for keyword in SKIP_KEYWORDS):
+                continue
+
+            # Дополнительная информация (в выгрузке - столбцы C и D)
+            info_values = (self._cell(row, columns['info_c']), self._cell(row, columns['info_d']))
+            additional_info = " ".join(str(value) for value in info_values if value)
+
+            # Собираем информацию о поставках для этого товара
+            shipments = {}
+            for date_info in shipment_dates:
+                shipment_value = self._parse_value(self._cell(row, date_info['column']))
+                if shipment_value > 0:
+                    shipments[date_info['display_date']] = shipment_value
+
+            products.append({
+                'name': product_name_str,
+                'additional_info': additional_info,
+                'collection': current_collection,
+                'reserve': self._parse_value(self._cell(row, columns['reserve'])),
+                'available': self._parse_value(self._cell(row, columns['available'])),
+                'shipments': shipments
+            })
+
+        return shipment_dates, products
+
+    def probe_modify_time(self, source):
+        """Время изменения файла склада без скачивания: MDTM на FTP или stat локального файла"""
+        if source['type'] != 'ftp':
+            return self.load_local_file(source['filename'])[1]
+
+        ftp = ftplib.FTP(timeout=FTP_TIMEOUT)
+        try:
+            with metrics.timer('stock_refresh_stage_seconds', stage='probe'):
+                ftp.connect(source['host'], int(source['port']))
+                ftp.login(source['username'], source['password'])
+                try:
+                    ftp.cwd(source['path'])
+                except ftplib.error_perm:
+                    pass
+                file_time = ftp.voidcmd(f"MDTM {source['filename']}")[4:].strip()
+            ftp.quit()
+        finally:
+            ftp.close()
+        utc_time = datetime.strptime(file_time, '%Y%m%d%H%M%S')
+        return utc_time.replace(tzinfo=pytz.utc).astimezone(MOSCOW_TZ)
+
+    def changed_sources(self):
+        """Склады, файл которых изменился с момента последней загрузки (или еще не загружался):
+        пары (источник, время изменения файла; None - если время не проверялось)"""
+        known = self.catalog.meta['sources']
+        changed = []
+        for source in self.sources:
+            warehouse = source['warehouse']
+            if warehouse not in known:
+                changed.append((source, None))
+                continue
+            try:
+                modify_time = self.probe_modify_time(source)
+            except Exception as e:
+                logger.warning(f"⚠️ Склад {warehouse}: не удалось проверить время файла: {e}")
+                continue
+            if modify_time != _catalog_parse_date(known[warehouse]['file_modify_time']):
+                changed.append((source, modify_time))
+        return changed
+
+    def background_ftp_update(self, sources=None):
+        """Фоновая загрузка данных с FTP (только указанных складов, если они заданы)"""
         if not self.auto_update_enabled:
             return False
             
         try:
             logger.info("🔄 Запуск фонового обновления данных с FTP...")
-            success = self.download_file_from_ftp()
+            success = self.refresh_sources(use_fallback=False, sources=sources)
             if success:
                 self.last_auto_update = datetime.now(MOSCOW_TZ)
                 logger.info("✅ Фоновое обновление данных завершено успешно")
@@ -511,130 +2096,1207 @@ class StockBot:
         except (ValueError, TypeError):
             return 0
     
+    def _find_indices(self, catalog, search_term_lower):
+        """Номера товаров по запросу: товары с точно таким названием (двоичный поиск по индексу),
+        иначе подстрока по всему каталогу, а запрос с названием раздела ('UNION 1K') ищется только
+        среди товаров раздела. Если в разделе ничего нет, запрос ищется целиком по всему каталогу -
+        название раздела может быть началом названия товара ('Клей ПВА 2')"""
+        found = catalog.find_exact(search_term_lower)
+        if found:
+            return found
+        scope, scoped_term = self._resolve_scope(search_term_lower, catalog.collections)
+        if scope is not None:
+            found = catalog.find(scoped_term, scope)
+            if found:
+                return found
+        return catalog.find(search_term_lower)
+
+    def _resolve_scope(self, search_term_lower, collections):
+        """Запрос вида 'UNION 1K' -> (номера товаров раздела UNION, '1k')"""
+        parts = search_term_lower.split(None, 1)
+        if len(parts) == 2 and parts[0] in collections:
+            return collections[parts[0]][1], parts[1].strip()
+        return None, search_term_lower
+
+    @metrics.timed('bot_search_seconds', kind='single')
     def search_products(self, search_term):
         """Поиск товаров по артикулу"""
-        if not self.products:
-            return []
-            
+        catalog, found = self.search_indices(search_term)
+        return [catalog.product(idx) for idx in found]
+
+    def search_indices(self, search_term):
+        """Поиск по артикулу: снимок каталога и номера найденных в нем товаров"""
+        catalog = self.catalog
+        if not catalog.count:
+            return catalog, []
+
         try:
-            results = []
-            search_term_lower = search_term.lower()
-            
-            for product in self.products:
-                if search_term_lower in product['name'].lower():
-                    results.append(product)
-            
-            return results
-            
+            return catalog, self._find_indices(catalog, search_term.lower())
+
         except Exception as e:
             logger.error(f"Ошибка при поиске: {e}")
+            return catalog, []
+
+    @metrics.timed('bot_search_seconds', kind='bulk')
+    def search_products_bulk(self, search_terms):
+        """Поиск сразу по нескольким артикулам по одному снимку каталога"""
+        results = {term: [] for term in search_terms}
+        catalog = self.catalog
+        if not catalog.count:
+            return results
+
+        try:
+            # Правила те же, что у одиночного запроса: точные названия - двоичным поиском по индексу,
+            # остальные артикулы - за один общий проход по куче названий (для запроса с разделом -
+            # товары раздела, а если их нет - весь каталог)
+            scopes = {}
+            needles = set()
+            for term in search_terms:
+                term_lower = term.lower()
+                exact = catalog.find_exact(term_lower)
+                if exact:
+                    results[term] = [catalog.product(idx) for idx in exact]
+                    continue
+                scope, scoped_term = self._resolve_scope(term_lower, catalog.collections)
+                scopes[term] = (term_lower, scope, scoped_term)
+                needles.add(term_lower)
+                if scope is not None:
+                    needles.add(scoped_term)
+            hits = catalog.find_many(needles) if needles else {}
+
+            for term, (term_lower, scope, scoped_term) in scopes.items():
+                found = []
+                if scope is not None:
+                    found = [idx for idx in hits[scoped_term] if catalog.in_collection(idx, scope)]
+                if not found:
+                    found = hits[term_lower]
+                results[term] = [catalog.product(idx) for idx in found]
+
+            return results
+
+        except Exception as e:
+            logger.error(f"Ошибка при массовом поиске: {e}")
+            return results
+
+    def get_collection(self, name):
+        """Товары раздела каталога по названию (без учета регистра)"""
+        entry = self.catalog.collections.get(name.lower().strip())
+        if not entry:
             return []
-    
+        return [self.catalog.product(idx) for idx in entry[1]]
+
+    def list_collections(self):
+        """Разделы каталога в порядке файла с количеством товаров"""
+        return [(name, len(indices)) for name, indices in self.catalog.collections.values()]
+
+    def _format_number(self, value):
+        """Число для таблиц и файлов: без лишних нулей, 201 - 'Более 200'"""
+        if value == 201:
+            return "Более 200"
+        return f"{value:.3f}".rstrip('0').rstrip('.')
+
+    @metrics.timed('bot_format_seconds')
     def format_product_info(self, product):
-        """Форматирование информации о товаре для ответа с эмодзи"""
+        """Карточка товара с эмодзи в HTML-разметке; текст из файла экранируется"""
         try:
-            reserve = product['reserve']
-            available = product['available']
             additional_info = product['additional_info']
             
-            info_suffix = f" ({additional_info})" if additional_info else ""
-            
-            reserve_str = "🔴 0" if reserve == 0 else f"🟢 {reserve:.3f}".rstrip('0').rstrip('.') if reserve != 201 else "🟢 Более 200"
-            available_str = "🔴 0" if available == 0 else f"🟢 {available:.3f}".rstrip('0').rstrip('.') if available != 201 else "🟢 Более 200"
+            info_suffix = html.escape(f" ({additional_info})") if additional_info else ""
             
-            reserve_str += info_suffix
-            available_str += info_suffix
+            product_info = f"🏷️ <b>{html.escape(product['name'])}</b>\n"
+            if product.get('collection'):
+                product_info += f"📂 Раздел: {html.escape(product['collection'])}\n"
             
-            product_info = f"🏷️ *{product['name']}*\n\n"
-            product_info += f"🏢 *Склад Санкт-Петербург:*\n"
-            product_info += f"🛡️ В резерве: {reserve_str}\n"
-            product_info += f"📦 Доступно сейчас: {available_str}\n"
-            
-            if product['shipments']:
-                sorted_shipments = sorted(
-                    product['shipments'].items(),
-                    key=lambda x: self._parse_date(x[0]) or datetime.max
-                )
+            warehouses = product.get('warehouses') or {WAREHOUSE_NAME: product}
+            for warehouse, stock in warehouses.items():
+                reserve = stock['reserve']
+                available = stock['available']
+                
+                reserve_str = "🔴 0" if reserve == 0 else f"🟢 {reserve:.3f}".rstrip('0').rstrip('.') if reserve != 201 else "🟢 Более 200"
+                available_str = "🔴 0" if available == 0 else f"🟢 {available:.3f}".rstrip('0').rstrip('.') if available != 201 else "🟢 Более 200"
+                
+                reserve_str += info_suffix
+                available_str += info_suffix
+                
+                product_info += "\n"
+                product_info += f"🏢 <b>Склад {html.escape(warehouse)}:</b>\n"
+                product_info += f"🛡️ В резерве: {reserve_str}\n"
+                product_info += f"📦 Доступно сейчас: {available_str}\n"
                 
-                product_info += f"\n🚚 *Ожидаются поступления:*\n"
-                for date_display, quantity in sorted_shipments:
-                    quantity_str = "🟢 Более 200" if quantity == 201 else f"🟢 {quantity:.3f}".rstrip('0').rstrip('.')
-                    product_info += f"📅 {date_display}: {quantity_str}{info_suffix}\n"
+                # Поставки в снимке уже идут по возрастанию даты
+                if stock['shipments']:
+                    product_info += "\n🚚 <b>Ожидаются поступления:</b>\n"
+                    for date_display, quantity in stock['shipments'].items():
+                        quantity_str = "🟢 Более 200" if quantity == 201 else f"🟢 {quantity:.3f}".rstrip('0').rstrip('.')
+                        product_info += f"📅 {html.escape(date_display)}: {quantity_str}{info_suffix}\n"
             
             return product_info
                    
         except Exception as e:
             logger.error(f"Ошибка при форматировании: {e}")
-            return f"❌ Ошибка при обработке товара: {product.get('name', 'Неизвестно')}"
+            return f"❌ Ошибка при обработке товара: {html.escape(product.get('name', 'Неизвестно'))}"
+
+    def product_card(self, catalog, idx):
+        """Карточка товара из кеша снимка: форматируется и экранируется один раз на снимок"""
+        card = catalog.cards.get(idx)
+        if card is None:
+            card = catalog.cards[idx] = self.format_product_info(catalog.product(idx))
+        return card
+
+class UpdateScheduler:
+    """Интервал проверки файла по рабочим окнам и истории изменений (MDTM)"""
+
+    def __init__(self, window=AUTO_UPDATE_WINDOW):
+        self.window = window if window in UPDATE_WINDOW_PRESETS else 'always'
+        self.history = deque(maxlen=AUTO_UPDATE_HISTORY_SIZE)
+        self.idle_checks = 0
+        self.next_check = None
+
+    def to_state(self):
+        return {'window': self.window, 'history': [_catalog_date(changed) for changed in self.history]}
+
+    def load_state(self, state):
+        if state.get('window') in UPDATE_WINDOW_PRESETS:
+            self.window = state['window']
+        self.history.clear()
+        self.history.extend(_catalog_parse_date(changed) for changed in state.get('history', []))
+
+    def in_window(self, now):
+        windows = UPDATE_WINDOW_PRESETS[self.window][1]
+        if windows is None:
+            return True
+        minute = now.hour * 60 + now.minute
+        return any(now.weekday() in days and start <= minute < end for days, start, end in windows)
+
+    def seconds_to_window(self, now):
+        """Секунды до начала ближайшего рабочего окна (в пределах недели)"""
+        windows = UPDATE_WINDOW_PRESETS[self.window][1] or []
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        starts = [
+            midnight + timedelta(days=offset, minutes=start)
+            for offset in range(8)
+            for days, start, _ in windows
+            if (now.weekday() + offset) % 7 in days
+        ]
+        upcoming = [start for start in starts if start > now]
+        return (min(upcoming) - now).total_seconds() if upcoming else AUTO_UPDATE_MAX_INTERVAL
+
+    def expected_soon(self, now):
+        """Файл обычно меняется в это время суток (минимум два изменения в истории рядом с ним)"""
+        minute = now.hour * 60 + now.minute
+        window = AUTO_UPDATE_EXPECTED_WINDOW // 60
+        hits = 0
+        for changed in self.history:
+            distance = abs(changed.hour * 60 + changed.minute - minute)
+            if min(distance, 24 * 60 - distance) <= window:
+                hits += 1
+        return hits >= 2
+
+    def record_check(self, changed, modify_times=()):
+        """Итог проверки; в историю попадает время изменения файла (MDTM), а не время, когда проверка
+        его заметила - иначе при редких проверках выученное время сдвигалось бы на часы"""
+        if changed:
+            for modify_time in sorted(modify_times):
+                # Если загрузка не удалась, то же изменение найдется и при следующей проверке
+                if modify_time not in self.history:
+                    self.history.append(modify_time)
+            self.idle_checks = 0
+        else:
+            self.idle_checks += 1
+
+    def next_interval(self, now):
+        if not self.in_window(now):
+            return max(AUTO_UPDATE_MIN_INTERVAL, min(AUTO_UPDATE_MAX_INTERVAL, self.seconds_to_window(now)))
+        if self.expected_soon(now):
+            return AUTO_UPDATE_MIN_INTERVAL
+        # Экспоненциальное замедление, пока файл не меняется
+        return min(AUTO_UPDATE_MIN_INTERVAL * 2 ** min(self.idle_checks, 16), AUTO_UPDATE_MAX_INTERVAL)
+
+    def typical_times(self, limit=4):
+        """Обычное время изменения файла: самые частые получасовые интервалы из истории"""
+        buckets = {}
+        for changed in self.history:
+            bucket = (changed.hour, changed.minute // 30 * 30)
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        frequent = sorted((bucket for bucket, count in buckets.items() if count >= 2), key=lambda b: -buckets[b])
+        return [f"{hour:02d}:{minute:02d}" for hour, minute in sorted(frequent[:limit])]
+
+# Глобальный экземпляр бота
+stock_bot = StockBot()
+update_scheduler = UpdateScheduler()
+
+# Разделители списка артикулов. Запятая между цифрами остается внутри артикула, только если за ней
+# идет размер ('Плитка 60,5x30', 'Подложка 1,5 мм'); '02-06,03-07' - это два артикула
+SEARCH_TERMS_SEPARATOR = re.compile(r'[\n;]+|,(?!(?<=\d,)\d+\s*(?:[xх×]|мм|см))', re.IGNORECASE)
+
+def parse_search_terms(text):
+    """Разбивает сообщение на список артикулов (по строкам, запятым и точкам с запятой).
+    Десятичная запятая в размере ('Плитка 60,5x30') разделителем не считается"""
+    terms = []
+    seen = set()
+    for part in SEARCH_TERMS_SEPARATOR.split(text):
+        term = part.strip()
+        if term and term.lower() not in seen:
+            seen.add(term.lower())
+            terms.append(term)
+    return terms[:BULK_MAX_TERMS]
+
+def md_escape(text):
+    """Экранирование текста из файла для Markdown: символы разметки вне сущностей через обратную косую черту"""
+    return re.sub(r'([_*`\[])', r'\\\1', text or '')
+
+def strip_markup(text, parse_mode):
+    """Текст без разметки для повторной отправки, если Telegram ее не разобрал"""
+    if parse_mode == 'HTML':
+        return html.unescape(re.sub(r'<[^>]+>', '', text))
+    return re.sub(r'\\([_*`\[])', r'\1', re.sub(r'(?<!\\)[*_`]', '', text))
+
+async def send_rendered(send, text, parse_mode='Markdown', **kwargs):
+    """Отправка размеченного текста; только если Telegram не разобрал разметку - повтор без нее"""
+    metrics.inc('bot_rendered_messages_total', parse_mode=parse_mode)
+    try:
+        return await send(text, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        if "can't parse entities" not in str(e).lower():
+            raise
+        metrics.inc('bot_render_errors_total', parse_mode=parse_mode)
+        logger.warning(f"⚠️ Разметка сообщения не разобрана ({e}), отправка без разметки")
+        return await send(strip_markup(text, parse_mode), **kwargs)
+
+def write_table_file(headers, rows, file_format='xlsx', sheet_title='Остатки'):
+    """Потоковая запись таблицы во временный XLSX/CSV файл, возвращает путь к файлу"""
+    suffix = '.csv' if file_format == 'csv' else '.xlsx'
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+
+    try:
+        if file_format == 'csv':
+            with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.writer(f, delimiter=';')
+                writer.writerow(headers)
+                for row in rows:
+                    writer.writerow(row)
+        else:
+            import openpyxl
+
+            # write_only режим пишет строки сразу на диск и не держит лист в памяти
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet = workbook.create_sheet(title=sheet_title)
+            sheet.append(headers)
+            for row in rows:
+                sheet.append(row)
+            workbook.save(path)
+        return path
+    except Exception:
+        os.remove(path)
+        raise
+
+BULK_HEADERS = ['Запрос', 'Товар', 'Доп. информация', 'В резерве', 'Доступно', 'Ближайшее поступление']
+
+def next_shipment_text(product):
+    """Ближайшее ожидаемое поступление товара в виде 'дата: количество'"""
+    if not product['shipments']:
+        return ''
+    date_display, quantity = min(
+        product['shipments'].items(),
+        key=lambda x: stock_bot._parse_date(x[0]) or datetime.max
+    )
+    return f"{date_display}: {stock_bot._format_number(quantity)}"
+
+def bulk_result_rows(search_terms, results):
+    """Строки сводной таблицы массового поиска"""
+    for term in search_terms:
+        if not results[term]:
+            yield [term, 'Не найдено', '', '', '', '']
+            continue
+        for product in results[term]:
+            yield [
+                term,
+                product['name'],
+                product['additional_info'],
+                stock_bot._format_number(product['reserve']),
+                stock_bot._format_number(product['available']),
+                next_shipment_text(product)
+            ]
+
+async def send_bulk_results(update: Update, search_terms):
+    """Один сводный ответ на список артикулов: сообщением или файлом"""
+    # Поиск по длинному списку - работа для процессора, event loop отдаем легким запросам
+    results = await asyncio.to_thread(stock_bot.search_products_bulk, search_terms)
+    found_terms = sum(1 for term in search_terms if results[term])
+    total_rows = sum(max(len(results[term]), 1) for term in search_terms)
+
+    header = (
+        f"📋 *Поиск по списку:* {len(search_terms)} артикулов, "
+        f"найдено {found_terms}, строк {total_rows}"
+    )
+    footer = ""
+    if stock_bot.file_modify_time:
+        footer = f"\n\n⏰ *Данные обновлены:* {stock_bot.file_modify_time.strftime('%d.%m.%Y %H:%M')}"
+
+    if total_rows <= BULK_MAX_ROWS_IN_MESSAGE:
+        lines = []
+        for term in search_terms:
+            if not results[term]:
+                lines.append(f"❌ {md_escape(term)} - не найдено")
+                continue
+            for product in results[term]:
+                info_suffix = f" ({md_escape(product['additional_info'])})" if product['additional_info'] else ""
+                line = (
+                    f"🏷️ {md_escape(product['name'])}{info_suffix}\n"
+                    f"    🛡️ {stock_bot._format_number(product['reserve'])}"
+                    f" | 📦 {stock_bot._format_number(product['available'])}"
+                )
+                shipment = next_shipment_text(product)
+                if shipment:
+                    line += f" | 🚚 {shipment}"
+                lines.append(line)
+
+        text = header + "\n\n" + "\n".join(lines) + footer
+        if len(text) <= TELEGRAM_MESSAGE_LIMIT:
+            await send_rendered(update.message.reply_text, text)
+            return
+
+    # Большой список - одним XLSX файлом, генерация вне event loop
+    rows = list(bulk_result_rows(search_terms, results))
+    path = await asyncio.to_thread(write_table_file, BULK_HEADERS, rows, 'xlsx', 'Поиск')
+    try:
+        filename = f"poisk_{datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M')}.xlsx"
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document=document,
+                filename=filename,
+                caption=(header + footer)[:1024],
+                parse_mode='Markdown'
+            )
+    finally:
+        os.remove(path)
+
+EXPORT_USAGE = (
+    "📤 *Выгрузка остатков*\n\n"
+    "`/export [начало названия] [раздел=UNION] [min=N] [date=ДД.ММ.ГГГГ] [csv]`\n\n"
+    "• `раздел=UNION` - только товары раздела каталога (список: /collections)\n"
+    "• `min=1` - только товары с доступным количеством не меньше N\n"
+    "• `date=15.11.2025` - только товары с поступлением до этой даты\n"
+    "• `csv` - выгрузить в CSV вместо XLSX\n\n"
+    "💡 *Пример:* `/export раздел=UNION min=1`"
+)
+
+def parse_export_args(args):
+    """Разбор аргументов команды /export в словарь фильтров"""
+    filters_ = {'prefix': None, 'collection': None, 'min_available': None, 'shipment_until': None, 'format': 'xlsx'}
+    prefix_parts = []
+
+    for arg in args:
+        arg_lower = arg.lower()
+        if arg_lower in ('csv', 'xlsx'):
+            filters_['format'] = arg_lower
+        elif arg_lower.startswith(('раздел=', 'collection=')):
+            filters_['collection'] = arg.split('=', 1)[1]
+        elif arg_lower.startswith('min='):
+            filters_['min_available'] = float(arg[4:].replace(',', '.'))
+        elif arg_lower.startswith('date='):
+            shipment_until = stock_bot._parse_date(arg[5:])
+            if not shipment_until:
+                raise ValueError(f"Неверная дата: {arg[5:]}")
+            filters_['shipment_until'] = shipment_until
+        else:
+            prefix_parts.append(arg)
+
+    if prefix_parts:
+        filters_['prefix'] = ' '.join(prefix_parts).lower()
+    return filters_
+
+def export_rows(products, shipment_dates, filters_, warehouses=()):
+    """Ленивая генерация строк выгрузки по снимку остатков"""
+    prefix = filters_['prefix']
+    min_available = filters_['min_available']
+    shipment_until = filters_['shipment_until']
+    # Даты снимка уже разобраны - фильтр сравнивает подписи дат, а не разбирает их для каждого товара
+    dates_until = {
+        date_info['display_date'] for date_info in shipment_dates
+        if shipment_until and date_info['date'] <= shipment_until
+    }
+
+    for product in products:
+        if prefix and not product['name'].lower().startswith(prefix):
+            continue
+        if min_available is not None and product['available'] < min_available:
+            continue
+        if shipment_until and not any(date_display in dates_until for date_display in product['shipments']):
+            continue
+
+        row = [
+            product['name'],
+            product['collection'] or '',
+            product['additional_info'],
+            'Более 200' if product['reserve'] == 201 else product['reserve'],
+            'Более 200' if product['available'] == 201 else product['available']
+        ]
+        # При нескольких складах - остатки каждого склада отдельными столбцами
+        for warehouse in warehouses:
+            stock = product.get('warehouses', {}).get(warehouse)
+            if stock:
+                row.append('Более 200' if stock['reserve'] == 201 else stock['reserve'])
+                row.append('Более 200' if stock['available'] == 201 else stock['available'])
+            else:
+                row.extend([None, None])
+        for date_info in shipment_dates:
+            quantity = product['shipments'].get(date_info['display_date'])
+            row.append('Более 200' if quantity == 201 else quantity)
+        yield row
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /export - выгрузка отфильтрованных остатков файлом"""
+    try:
+        user = update.effective_user
+        update_user(user.id, user.username, user.first_name, user.last_name)
+
+        if not is_user_allowed(user.id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        if await reply_if_warming(update.message):
+            return
+
+        try:
+            filters_ = parse_export_args(context.args or [])
+        except ValueError:
+            await update.message.reply_text(EXPORT_USAGE, parse_mode='Markdown')
+            return
+
+        # Снимок данных на момент запроса - фоновое обновление его не изменит
+        products = stock_bot.products
+        shipment_dates = stock_bot.shipment_dates
+        if not products:
+            await update.message.reply_text("❌ *Данные об остатках еще не загружены.*", parse_mode='Markdown')
+            return
+
+        # Фильтр по разделу берет товары сразу из индекса разделов
+        if filters_['collection']:
+            products = stock_bot.get_collection(filters_['collection'])
+            if not products:
+                await send_rendered(
+                    update.message.reply_text,
+                    f"❌ *Раздел '{md_escape(filters_['collection'])}' не найден.* Список разделов: /collections"
+                )
+                return
+
+        status_message = await update.message.reply_text("📤 *Формирование файла...*", parse_mode='Markdown')
+
+        headers = ['Товар', 'Раздел', 'Доп. информация', 'В резерве', 'Доступно']
+        warehouses = [source['warehouse'] for source in stock_bot.sources] if len(stock_bot.sources) > 1 else []
+        for warehouse in warehouses:
+            headers += [f"В резерве ({warehouse})", f"Доступно ({warehouse})"]
+        headers += [f"Поступление {date_info['display_date']}" for date_info in shipment_dates]
+
+        # Счетчик строк заполняется генератором внутри потока записи
+        row_counter = {'count': 0}
+
+        def counted_rows():
+            for row in export_rows(products, shipment_dates, filters_, warehouses):
+                row_counter['count'] += 1
+                yield row
+
+        path = await asyncio.to_thread(write_table_file, headers, counted_rows(), filters_['format'])
+        try:
+            if not row_counter['count']:
+                await status_message.edit_text("❌ *По заданным условиям товары не найдены.*", parse_mode='Markdown')
+                return
+
+            filename = f"ostatki_{datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M')}.{filters_['format']}"
+            caption = f"📤 Выгрузка остатков: {row_counter['count']} товаров"
+            if stock_bot.file_modify_time:
+                caption += f"\n⏰ Данные обновлены: {stock_bot.file_modify_time.strftime('%d.%m.%Y %H:%M')}"
+
+            with open(path, 'rb') as document:
+                await update.message.reply_document(document=document, filename=filename, caption=caption)
+            await status_message.delete()
+        finally:
+            os.remove(path)
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /export: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при формировании выгрузки.")
+
+ARRIVALS_PAGE_SIZE = 20
+ARRIVALS_DEFAULT_DAYS = 7
+ARRIVALS_USAGE = (
+    "🚚 *Поступления*\n\n"
+    "• `/arrivals` - поступления на ближайшую неделю\n"
+    "• `/arrivals 01.11 15.11` - поступления за период\n"
+    "• `/arrivals 01.11.2025` - поступления в один день\n"
+    "• `/arrivals 02-06` - ближайшее поступление по артикулу"
+)
+
+def parse_arrival_date(text, today):
+    """Дата ДД.ММ или ДД.ММ.ГГГГ; без года - ближайшая такая дата не раньше чем полгода назад"""
+    match = re.fullmatch(r'(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?', text.strip())
+    if not match:
+        return None
+    day, month, year = match.groups()
+    if year:
+        return datetime(int(year) + (2000 if len(year) == 2 else 0), int(month), int(day))
+    value = datetime(today.year, int(month), int(day))
+    if value < today - timedelta(days=183):
+        value = value.replace(year=today.year + 1)
+    return value
+
+def parse_arrivals_args(args):
+    """Разбор аргументов /arrivals: ('range', начало, конец) или ('product', артикул)"""
+    today = moscow_now().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    if not args:
+        return 'range', today, today + timedelta(days=ARRIVALS_DEFAULT_DAYS)
+
+    dates = [parse_arrival_date(arg, today) for arg in args[:2]]
+    if len(args) <= 2 and all(dates):
+        start, end = dates[0], dates[-1]
+        if end < start:
+            end = end.replace(year=end.year + 1)
+        return 'range', start, end
+    return 'product', " ".join(args)
+
+def build_arrivals_page(start, end, offset=0):
+    """Страница поступлений за период по индексу поставок снимка"""
+    catalog = stock_bot.catalog
+    positions = catalog.arrival_range(start, end)
+    period = f"{start.strftime('%d.%m.%Y')} - {end.strftime('%d.%m.%Y')}" if start != end else start.strftime('%d.%m.%Y')
+    if not positions:
+        return f"🚚 *Поступлений за {period} нет*", None
+
+    page = positions[offset:offset + ARRIVALS_PAGE_SIZE]
+    text = f"🚚 *Поступления за {period}* ({len(positions)}):\n"
+    current_date = None
+    for position in page:
+        date, idx, quantity = catalog.arrival(position)
+        if date != current_date:
+            text += f"\n📅 *{date.strftime('%d.%m.%Y')}*\n"
+            current_date = date
+        text += f"• {md_escape(catalog.product(idx)['name'])} - {stock_bot._format_number(quantity)}\n"
+
+    # В callback_data помещаются только дни периода и смещение
+    period_data = f"{start.toordinal()}:{end.toordinal()}"
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(
+            "◀️ Назад", callback_data=f"arrivals:{period_data}:{max(offset - ARRIVALS_PAGE_SIZE, 0)}"
+        ))
+    if offset + ARRIVALS_PAGE_SIZE < len(positions):
+        buttons.append(InlineKeyboardButton(
+            "Далее ▶️", callback_data=f"arrivals:{period_data}:{offset + ARRIVALS_PAGE_SIZE}"
+        ))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+def build_product_arrivals(term):
+    """Ближайшие поступления товаров по артикулу"""
+    catalog = stock_bot.catalog
+    term_lower = term.lower()
+    found = catalog.find_exact(term_lower) or catalog.find(term_lower)
+    if not found:
+        return f"❌ Товар '{md_escape(term)}' не найден"
+
+    today = moscow_now().replace(tzinfo=None)
+    text = "🚚 *Ближайшие поступления:*\n\n"
+    for idx in found[:ARRIVALS_PAGE_SIZE]:
+        arrival = catalog.next_arrival(idx, today)
+        name = md_escape(catalog.product(idx)['name'])
+        if arrival:
+            date, quantity = arrival
+            text += f"• {name} - {date.strftime('%d.%m.%Y')}: {stock_bot._format_number(quantity)}\n"
+        else:
+            text += f"• {name} - поступлений не ожидается\n"
+    if len(found) > ARRIVALS_PAGE_SIZE:
+        text += f"\n… и еще {len(found) - ARRIVALS_PAGE_SIZE}. Уточните запрос."
+    return text
+
+async def arrivals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /arrivals - поступления за период или по артикулу"""
+    try:
+        user = update.effective_user
+        if not is_user_allowed(user.id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        if await reply_if_warming(update.message):
+            return
+
+        try:
+            query = parse_arrivals_args(context.args or [])
+        except ValueError:
+            await update.message.reply_text(ARRIVALS_USAGE, parse_mode='Markdown')
+            return
+
+        if query[0] == 'range':
+            text, reply_markup = build_arrivals_page(query[1], query[2])
+        else:
+            text, reply_markup = build_product_arrivals(query[1]), None
+        await send_rendered(update.message.reply_text, text, reply_markup=reply_markup)
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /arrivals: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при получении поступлений.")
+
+async def arrivals_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание страниц /arrivals"""
+    try:
+        query = update.callback_query
+        await query.answer()
+        if not is_user_allowed(query.from_user.id):
+            return
+
+        _, start, end, offset = query.data.split(':')
+        text, reply_markup = build_arrivals_page(
+            datetime.fromordinal(int(start)), datetime.fromordinal(int(end)), int(offset)
+        )
+        await send_rendered(query.edit_message_text, text, reply_markup=reply_markup)
+
+    except Exception as e:
+        logger.error(f"Ошибка при листании поступлений: {e}")
+
+async def collections_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /collections - разделы каталога с количеством товаров"""
+    try:
+        user = update.effective_user
+        if not is_user_allowed(user.id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        if await reply_if_warming(update.message):
+            return
+
+        collections = stock_bot.list_collections()
+        if not collections:
+            await update.message.reply_text("📂 *Разделы каталога не загружены*", parse_mode='Markdown')
+            return
+
+        text = "📂 *Разделы каталога:*\n\n"
+        for name, count in collections:
+            text += f"• {md_escape(name)}: {count} товаров\n"
+        text += (
+            "\n💡 Поиск внутри раздела: `UNION 1K`\n"
+            "📤 Выгрузка раздела: `/export раздел=UNION`"
+        )
+        await update.message.reply_text(text, parse_mode='Markdown')
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /collections: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при получении списка разделов.")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API с замером времени каждого вызова Telegram"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_telegram_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.observe('bot_telegram_request_seconds', time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            metrics.inc('bot_telegram_errors_total', method=api_method)
+        return code, payload
+
+def update_lane(update):
+    """Полоса обработки апдейта: 'heavy' для выгрузок, админ-действий и поиска по списку, иначе 'light'"""
+    if not isinstance(update, Update):
+        return 'light'
+    if update.callback_query:
+        return 'heavy' if (update.callback_query.data or '').startswith(HEAVY_CALLBACKS) else 'light'
+    text = update.message.text if update.message and update.message.text else ''
+    if text.startswith('/'):
+        command = text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+        return 'heavy' if command in HEAVY_COMMANDS else 'light'
+    return 'heavy' if len(parse_search_terms(text)) > 1 else 'light'
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с порядком внутри чата, двумя полосами и ограничением очереди"""
+
+    def __init__(self, light_limit=UPDATE_CONCURRENCY, heavy_limit=HEAVY_UPDATE_CONCURRENCY,
+                 heavy_queue_limit=HEAVY_QUEUE_LIMIT):
+        # Общий семафор базового класса не ограничивает: ждать апдейты должны в своей полосе
+        super().__init__(UPDATE_QUEUE_LIMIT + light_limit + heavy_limit)
+        self._lanes = {'light': asyncio.Semaphore(light_limit), 'heavy': asyncio.Semaphore(heavy_limit)}
+        self.heavy_queue_limit = heavy_queue_limit
+        self.pending = {'light': 0, 'heavy': 0}
+        # chat_id -> [блокировка, число апдейтов чата в обработке или ожидании]
+        self._chat_locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def backlog(self):
+        return self.pending['light'] + self.pending['heavy']
+
+    async def do_process_update(self, update, coroutine):
+        lane = update_lane(update)
+        if lane == 'heavy' and self.pending['heavy'] >= self.heavy_queue_limit:
+            # Очередь тяжелых запросов переполнена: сразу отвечаем, а не копим задачи
+            coroutine.close()
+            metrics.inc('bot_updates_rejected_total', lane=lane)
+            await self._reject(update)
+            return
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        entry = None
+        if chat:
+            entry = self._chat_locks.get(chat.id)
+            if entry is None:
+                entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        self.pending[lane] += 1
+        queued = time.perf_counter()
+        try:
+            # Апдейты одного чата обрабатываются по очереди; слот полосы занимается только после
+            # своей очереди в чате, поэтому ожидание в чате не отнимает слоты у других пользователей
+            async with entry[0] if entry else contextlib.nullcontext():
+                async with self._lanes[lane]:
+                    metrics.observe('bot_update_queue_seconds', time.perf_counter() - queued, lane=lane)
+                    await coroutine
+        finally:
+            self.pending[lane] -= 1
+            if entry:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chat_locks[chat.id]
+
+    @staticmethod
+    async def _reject(update):
+        text = "⏳ Бот сейчас перегружен, повторите запрос через минуту."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Не удалось ответить на отклоненный апдейт: {e}")
+
+# Блокировка refresh.lock в SHARED_DIR, удерживаемая обновляющим экземпляром
+_leadership = {'file': None}
+
+def is_refresh_leader():
+    """Этот экземпляр скачивает и публикует каталог: без SHARED_DIR - всегда, иначе владелец refresh.lock"""
+    if not SHARED_DIR or _leadership['file']:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # Без fcntl (Windows) выбор невозможен - каждый экземпляр обновляется сам
+        return True
+
+    lock_file = open(os.path.join(SHARED_DIR, 'refresh.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Блокировка держится, пока открыт файл, и снимается ОС при завершении процесса
+    _leadership['file'] = lock_file
+    logger.info("👑 Экземпляр выбран для обновления каталога")
+    return True
+
+def update_user_id(data):
+    """ID пользователя из апдейта Telegram (message, callback_query...), 0 если его нет"""
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id', 0)
+    return 0
+
+def worker_for_update(data):
+    """Номер экземпляра, обрабатывающего апдейт: все апдейты пользователя попадают в один процесс"""
+    if not WORKER_URLS:
+        return WORKER_INDEX
+    return update_user_id(data) % len(WORKER_URLS)
+
+async def start_http_server(application=None):
+    """HTTP сервер: / для проверки доступности (keep-alive), /metrics для Prometheus и прием webhook"""
+    from aiohttp import web, ClientSession, ClientTimeout
+
+    async def health(request):
+        return web.Response(text="OK")
+
+    async def metrics_endpoint(request):
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            return web.Response(status=401, headers={'WWW-Authenticate': 'Bearer'})
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def telegram_webhook(request):
+        # Без секрета кто угодно мог бы прислать апдейт от имени администратора
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        data = await request.json()
+
+        # Апдейт прямо от Telegram передаем экземпляру пользователя; если тот недоступен - обрабатываем сами
+        target = WORKER_INDEX if request.headers.get(ROUTED_HEADER) else worker_for_update(data)
+        if target != WORKER_INDEX:
+            headers = {ROUTED_HEADER: '1', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+            try:
+                async with app['client'].post(f"{WORKER_URLS[target]}{WEBHOOK_PATH}", json=data, headers=headers) as response:
+                    if response.status == 200:
+                        metrics.inc('bot_updates_routed_total', worker=str(target))
+                        return web.Response(text="OK")
+                    # Экземпляр перегружен - Telegram повторит доставку позже
+                    if response.status == 503:
+                        return web.Response(status=503)
+            except Exception as e:
+                logger.warning(f"⚠️ Экземпляр {target} недоступен, апдейт обработан локально: {e}")
+
+        processor = application.update_processor
+        if isinstance(processor, PriorityUpdateProcessor) and processor.backlog >= UPDATE_QUEUE_LIMIT:
+            metrics.inc('bot_updates_rejected_total', lane='webhook')
+            return web.Response(status=503)
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response(text="OK")
+
+    async def close_client(app):
+        await app['client'].close()
+
+    app = web.Application()
+    app.router.add_get('/', health)
+    if metrics.enabled and METRICS_TOKEN:
+        app.router.add_get('/metrics', metrics_endpoint)
+    elif metrics.enabled:
+        logger.warning("⚠️ METRICS_TOKEN не задан - endpoint /metrics отключен")
+    if application and (WEBHOOK_URL or WORKER_URLS):
+        app['client'] = ClientSession(timeout=ClientTimeout(total=5))
+        app.on_cleanup.append(close_client)
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT)
+    await site.start()
+    logger.info(f"🌐 HTTP сервер запущен на порту {HTTP_PORT}")
+    return runner
+
+def format_metrics_summary():
+    """Сводка производительности для админ-панели"""
+    rows = [
+        ("🔍 Поиск", 'bot_search_seconds'),
+        ("🧾 Форматирование", 'bot_format_seconds'),
+        ("🗄️ База данных", 'bot_db_seconds'),
+        ("✈️ Telegram API", 'bot_telegram_request_seconds'),
+        ("🔄 Обновление данных", 'stock_refresh_seconds')
+    ]
+    text = ""
+    for title, name in rows:
+        count, average, p95 = metrics.summary(name)
+        if count:
+            text += f"{title}: {count} шт., среднее {average * 1000:.2f} мс, p95 ≤ {p95 * 1000:.0f} мс\n"
+    errors = metrics.counter_total('bot_telegram_errors_total')
+    if errors:
+        text += f"⚠️ Ошибок Telegram API: {errors}\n"
+    render_errors = metrics.counter_total('bot_render_errors_total')
+    if render_errors:
+        rendered = metrics.counter_total('bot_rendered_messages_total')
+        text += f"⚠️ Ошибок разметки: {render_errors} из {rendered} ({render_errors / rendered:.1%})\n"
+    return text
+
+async def post_init(application: Application):
+    """Запуск фоновых служб после инициализации приложения"""
+    try:
+        application.bot_data['http_runner'] = await start_http_server(application)
+    except Exception as e:
+        logger.error(f"Не удалось запустить HTTP сервер: {e}")
+
+    # Webhook регистрирует один экземпляр, остальные получают апдейты от него
+    if WEBHOOK_URL and WORKER_INDEX == 0:
+        try:
+            await application.bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"🔗 Webhook установлен: {WEBHOOK_URL}")
+        except Exception as e:
+            logger.error(f"Не удалось установить webhook: {e}")
+
+    startup_mark("запуск приложения")
+    if _warmup['needed']:
+        _warmup['task'] = asyncio.create_task(warm_up_catalog())
+    else:
+        logger.info(f"⏱️ Профиль запуска: {format_startup_profile()}")
+
+async def post_stop(application: Application):
+    """Остановка: обработчики уже завершены, бот еще может отправлять сообщения"""
+    # Накопленные запросы на доступ уходят администратору сразу, не дожидаясь задачи
+    try:
+        await asyncio.wait_for(flush_approval_digest(application.bot), SHUTDOWN_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Не удалось отправить запросы на доступ при остановке: {e}")
+
+async def post_shutdown(application: Application):
+    """Завершение: сброс буферов в базу и контрольная точка каталога для быстрого перезапуска"""
+    steps = [("журнал действий", flush_admin_logs)]
+    # Общий снимок перезаписывает только обновляющий экземпляр
+    if not SHARED_DIR or _leadership['file']:
+        steps.append(("контрольная точка каталога", stock_bot.save_checkpoint))
+    for title, step in steps:
+        try:
+            await asyncio.wait_for(asyncio.to_thread(step), SHUTDOWN_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Ошибка при остановке ({title}): {e!r}")
+
+    runner = application.bot_data.pop('http_runner', None)
+    if runner:
+        await runner.cleanup()
+    logger.info("👋 Бот остановлен")
+
+# Загрузка каталога в фоне, если при запуске не нашлось снимка: бот отвечает сразу
+_warmup = {'needed': False, 'task': None}
+
+def catalog_warming():
+    """Каталог еще загружается после запуска"""
+    task = _warmup['task']
+    return task is not None and not task.done()
+
+async def reply_if_warming(message):
+    """Сообщить, что каталог еще загружается после запуска; True - если ответ отправлен"""
+    if stock_bot.catalog.count or not catalog_warming():
+        return False
+    await message.reply_text(
+        "⏳ *Данные загружаются после запуска бота.* Повторите запрос через минуту.",
+        parse_mode='Markdown'
+    )
+    return True
+
+def format_startup_profile():
+    phases = " · ".join(f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in _startup['phases'])
+    return f"{phases} · всего {sum(seconds for _, seconds in _startup['phases']) * 1000:.0f} мс"
 
-# Глобальный экземпляр бота
-stock_bot = StockBot()
+async def warm_up_catalog():
+    """Полная загрузка данных после старта бота (вместо блокирующей загрузки до запуска)"""
+    started = time.perf_counter()
+    try:
+        loaded = await asyncio.to_thread(stock_bot.load_data)
+        if loaded:
+            logger.info(
+                f"✅ Данные загружены. Товаров: {len(stock_bot.products)}, "
+                f"Дат поставок: {len(stock_bot.shipment_dates)}, источник: {stock_bot.data_source}"
+            )
+        else:
+            logger.error("❌ Не удалось загрузить данные")
+    except Exception as e:
+        logger.error(f"Ошибка фоновой загрузки данных: {e}")
+    finally:
+        _startup['phases'].append(("загрузка каталога (в фоне)", time.perf_counter() - started))
+        logger.info(f"⏱️ Профиль запуска: {format_startup_profile()}")
 
 # Функция для поддержания активности
 async def keep_alive():
     """Периодически отправляет запросы для поддержания активности"""
     if not os.environ.get('RENDER'):
         return
+    # httpx уже загружен вместе с python-telegram-bot; запрос не блокирует цикл событий
+    import httpx
         
-    while True:
-        try:
-            # Получаем URL приложения
-            app_name = os.environ.get('RENDER_SERVICE_NAME', 'union-stock-bot')
-            app_url = f"https://{app_name}.onrender.com"
-            response = requests.get(f"{app_url}/", timeout=10)
-            logger.info(f"✅ Keep-alive запрос отправлен: {response.status_code}")
-        except Exception as e:
-            logger.warning(f"⚠️ Keep-alive запрос не удался: {e}")
-        
-        await asyncio.sleep(300)  # Каждые 5 минут
+    async with httpx.AsyncClient(timeout=10) as client:
+        while True:
+            try:
+                # Получаем URL приложения
+                app_name = os.environ.get('RENDER_SERVICE_NAME', 'union-stock-bot')
+                app_url = f"https://{app_name}.onrender.com"
+                response = await client.get(f"{app_url}/")
+                logger.info(f"✅ Keep-alive запрос отправлен: {response.status_code}")
+            except Exception as e:
+                logger.warning(f"⚠️ Keep-alive запрос не удался: {e}")
+            
+            await asyncio.sleep(300)  # Каждые 5 минут
 
 # Фоновая задача для автоматического обновления
+async def notify_schema_error(bot):
+    """Уведомление администратора об ошибке структуры файла (один раз на каждую новую ошибку)"""
+    error = stock_bot.schema_error
+    if not error:
+        stock_bot.schema_error_notified = None
+        return
+    if error == stock_bot.schema_error_notified:
+        return
+
+    try:
+        await bot.send_message(
+            chat_id=ADMIN_ID,
+            text=(
+                "⚠️ Файл остатков не прошел проверку структуры листа\n\n"
+                f"Причина: {error}\n\n"
+                "Бот продолжает отвечать по предыдущим данным. "
+                "Проверьте выгрузку из 1С или схему листа (SHEET_SCHEMA)."
+            )
+        )
+        stock_bot.schema_error_notified = error
+    except Exception as e:
+        logger.error(f"Не удалось уведомить администратора об ошибке структуры файла: {e}")
+
+async def block_expiry_job(context: ContextTypes.DEFAULT_TYPE):
+    """Снятие истекших блокировок точно в срок и уведомление пользователей"""
+    try:
+        user_ids = expire_blocks()
+        for user_id in user_ids:
+            log_admin_action(ADMIN_ID, "block_expired", user_id)
+            try:
+                await context.bot.send_message(
+                    chat_id=user_id,
+                    text="🔓 *Срок блокировки истек.* Вы снова можете пользоваться ботом.",
+                    parse_mode='Markdown'
+                )
+            except Exception as e:
+                logger.error(f"Ошибка при уведомлении пользователя {user_id} о разблокировке: {e}")
+        if user_ids:
+            logger.info(f"🔓 Сняты истекшие блокировки: {len(user_ids)}")
+    except Exception as e:
+        logger.error(f"Ошибка при снятии истекших блокировок: {e}")
+    finally:
+        schedule_block_expiry()
+
+async def flush_admin_logs_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись буфера журнала действий в базу"""
+    if _admin_log_buffer:
+        await asyncio.to_thread(flush_admin_logs)
+
+async def compact_admin_logs_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ежедневная свертка старых записей журнала в дневные итоги"""
+    removed = await asyncio.to_thread(compact_admin_logs)
+    if removed:
+        logger.info(f"🗜️ Журнал действий: {removed} записей старше {ADMIN_LOG_RETENTION_DAYS} дн. свернуто в дневные итоги")
+
+async def shared_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """Экземпляры без обновления подхватывают общий снимок; при падении обновляющего один из них его заменяет"""
+    try:
+        if not is_refresh_leader():
+            await asyncio.to_thread(stock_bot.sync_shared_snapshot)
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации общего снимка: {e}")
+
+def schedule_auto_update(job_queue, delay=None):
+    """Назначение следующей проверки файла через интервал планировщика"""
+    for job in job_queue.get_jobs_by_name('auto_update'):
+        job.schedule_removal()
+    if delay is None:
+        delay = update_scheduler.next_interval(moscow_now())
+    update_scheduler.next_check = moscow_now() + timedelta(seconds=delay)
+    job_queue.run_once(auto_update_job, when=delay, name='auto_update')
+
 async def auto_update_job(context: ContextTypes.DEFAULT_TYPE):
-    """Фоновая задача для автоматического обновления данных"""
+    """Фоновая задача: проверка времени файла и загрузка только изменившихся складов"""
     try:
-        success = await asyncio.to_thread(stock_bot.background_ftp_update)
+        # Файл скачивает один экземпляр и при объединении публикует снимок, остальные его подключают;
+        # пока идет загрузка после запуска, проверять файл незачем
+        if not is_refresh_leader() or not stock_bot.auto_update_enabled or catalog_warming():
+            return
+        changed = await asyncio.to_thread(stock_bot.changed_sources)
+        update_scheduler.record_check(bool(changed), [modify_time for _, modify_time in changed if modify_time])
+        if not changed:
+            return
+        success = await asyncio.to_thread(stock_bot.background_ftp_update, [source for source, _ in changed])
         if success:
             logger.info("✅ Автоматическое обновление данных завершено")
         else:
             logger.warning("❌ Автоматическое обновление данных не удалось")
+        await notify_schema_error(context.bot)
     except Exception as e:
         logger.error(f"Ошибка в задаче автообновления: {e}")
+    finally:
+        schedule_auto_update(context.job_queue)
 
-async def send_approval_request(application, user_id, username, first_name, last_name):
-    """Отправка запроса на подтверждение администратору"""
-    if user_id == ADMIN_ID:
-        return
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Подтвердить", callback_data=f"approve_{user_id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{user_id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+def approval_user_info(user_id, username, first_name, last_name):
+    """Строки с данными пользователя для запроса на доступ"""
     user_info = f"ID: {user_id}\n"
     if username:
         user_info += f"Username: @{username}\n"
     user_info += f"Имя: {first_name or ''} {last_name or ''}".strip()
-    
-    message = (
-        "🆕 *Новый запрос на доступ к боту*\n\n"
-        f"{user_info}\n\n"
-        "Выберите действие:"
-    )
-    
-    try:
-        await application.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=message,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+    return user_info
+
+def approval_buttons(user_id, with_id=False):
+    """Ряд кнопок подтверждения/отклонения пользователя"""
+    suffix = f" {user_id}" if with_id else ""
+    return [
+        InlineKeyboardButton(f"✅ Подтвердить{suffix}", callback_data=f"approve_{user_id}"),
+        InlineKeyboardButton(f"❌ Отклонить{suffix}", callback_data=f"reject_{user_id}")
+    ]
+
+async def send_approval_request(application, user_id, username, first_name, last_name):
+    """Постановка запроса на доступ в очередь уведомлений администратора (с кулдауном)"""
+    if user_id == ADMIN_ID:
+        return
+
+    # Время уведомления записывается только после успешной отправки (flush_approval_digest),
+    # повторные сообщения пользователя до отправки лишь обновляют запрос в очереди
+    notified_at = _approval_notified.get(user_id)
+    if notified_at and (moscow_now() - notified_at).total_seconds() < APPROVAL_NOTIFY_COOLDOWN:
+        return
+    _approval_digest[user_id] = approval_user_info(user_id, username, first_name, last_name)
+
+    job_queue = application.job_queue
+    if not job_queue:
+        await flush_approval_digest(application.bot)
+    elif not job_queue.get_jobs_by_name('approval_digest'):
+        job_queue.run_once(approval_digest_job, when=APPROVAL_DIGEST_DELAY, name='approval_digest')
+
+async def flush_approval_digest(bot):
+    """Отправка накопленных запросов: один - отдельным сообщением, несколько - одной сводкой"""
+    if not _approval_digest:
+        return
+    requests_ = list(_approval_digest.items())
+    _approval_digest.clear()
+
+    if len(requests_) == 1:
+        user_id, user_info = requests_[0]
+        message = (
+            "🆕 *Новый запрос на доступ к боту*\n\n"
+            f"{md_escape(user_info)}\n\n"
+            "Выберите действие:"
         )
-        logger.info(f"✅ Запрос на доступ отправлен администратору для пользователя {user_id}")
+        reply_markup = InlineKeyboardMarkup([approval_buttons(user_id)])
+        parse_mode = 'Markdown'
+    else:
+        # Сводка без Markdown: при решениях по кнопкам текст дополняется через query.message.text
+        message = f"🆕 Новые запросы на доступ к боту: {len(requests_)}\n\n"
+        message += "\n\n".join(user_info for _, user_info in requests_)
+        keyboard = [approval_buttons(user_id, with_id=True) for user_id, _ in requests_[:APPROVAL_DIGEST_MAX_BUTTONS]]
+        if len(requests_) > APPROVAL_DIGEST_MAX_BUTTONS:
+            keyboard.append([InlineKeyboardButton("⏳ Все запросы", callback_data="admin_pending")])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        parse_mode = None
+
+    try:
+        send = functools.partial(bot.send_message, chat_id=ADMIN_ID)
+        if parse_mode:
+            await send_rendered(send, message[:TELEGRAM_MESSAGE_LIMIT], parse_mode, reply_markup=reply_markup)
+        else:
+            await send(message[:TELEGRAM_MESSAGE_LIMIT], reply_markup=reply_markup)
+        now = moscow_now()
+        for user_id, _ in requests_:
+            _approval_notified[user_id] = now
+        logger.info(f"✅ Запросы на доступ отправлены администратору: {', '.join(str(user_id) for user_id, _ in requests_)}")
     except Exception as e:
+        # Запросы возвращаются в очередь и уйдут со следующей отправкой; более свежие данные не затираем
+        for user_id, user_info in requests_:
+            _approval_digest.setdefault(user_id, user_info)
         logger.error(f"Не удалось отправить запрос администратору: {e}")
 
+async def approval_digest_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отложенная отправка сводки запросов на доступ"""
+    await flush_approval_digest(context.bot)
+
+def approval_status_update(message, user_id, status_text):
+    """Новый текст и клавиатура после решения: сводка теряет только кнопки этого пользователя"""
+    keyboard = message.reply_markup.inline_keyboard if message.reply_markup else ()
+    remaining = [
+        row for row in keyboard
+        if not any(button.callback_data in (f"approve_{user_id}", f"reject_{user_id}") for button in row)
+    ]
+    if not any(button.callback_data.startswith('approve_') for row in remaining for button in row):
+        return status_text, None
+    return f"{message.text}\n\n{status_text}"[:TELEGRAM_MESSAGE_LIMIT], InlineKeyboardMarkup(remaining)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     try:
@@ -646,14 +3308,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "🎯 *Бот для поиска остатков товаров*\n\n"
                 "🛠️ *Вы вошли как администратор*\n\n"
                 "Отправьте мне артикул товара и я найду:\n"
-                "• 🏢 Склад Санкт-Петербург (резерв и доступность)\n"
+                f"• 🏢 {stock_bot.warehouses_title()} (резерв и доступность)\n"
                 "• 🚚 Ожидаемые поступления (обновляются из файла)\n\n"
                 "💡 *Примеры запросов:*\n"
                 "• `02-06`\n"
                 "• `AR03-02`\n"
                 "• `UNION 1K`\n"
                 "• `Подложка`\n\n"
-                "🔄 *Данные автоматически обновляются каждые 5 минут*\n"
+                "📤 *Выгрузка в файл:* /export\n"
+                "🚚 *Поступления:* /arrivals\n"
+                "🔄 *Данные автоматически обновляются при изменении файла*\n"
                 "⚡ *Для доступа к админ-панели отправьте /admin*"
             )
             await update.message.reply_text(welcome_text, parse_mode='Markdown')
@@ -662,10 +3326,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_user_allowed(user.id):
             user_data = get_user(user.id)
             if not user_data or not user_data.is_approved:
-                pending_approvals = get_pending_approvals()
-                user_pending = any(u.user_id == user.id for u in pending_approvals)
-                
-                if not user_pending:
+                # Повторы и кулдаун отсекает send_approval_request по словарю в памяти
+                if not user_data or not user_data.is_blocked:
                     await send_approval_request(context.application, user.id, user.username, user.first_name, user.last_name)
                 
                 await update.message.reply_text(
@@ -680,14 +3342,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome_text = (
             "🎯 *Бот для поиска остатков товаров*\n\n"
             "Отправьте мне артикул товара и я найду:\n"
-            "• 🏢 Склад Санкт-Петербург (резерв и доступность)\n"
+            f"• 🏢 {stock_bot.warehouses_title()} (резерв и доступность)\n"
             "• 🚚 Ожидаемые поступления (обновляются из файла)\n\n"
             "💡 *Примеры запросов:*\n"
             "• `02-06`\n"
             "• `AR03-02`\n"
             "• `UNION 1K`\n"
             "• `Подложка`\n\n"
-            "🔄 *Данные автоматически обновляются каждые 5 минут*"
+            "📤 *Выгрузка в файл:* /export\n"
+            "🚚 *Поступления:* /arrivals\n"
+            "🔄 *Данные автоматически обновляются при изменении файла*"
         )
         await update.message.reply_text(welcome_text, parse_mode='Markdown')
     
@@ -722,26 +3386,41 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not user_input:
             await update.message.reply_text("❌ Пожалуйста, введите артикул для поиска.")
             return
-        
+
+        if await reply_if_warming(update.message):
+            return
+
+        # Список артикулов (заказ построчно или через запятую) - один сводный ответ
+        search_terms = parse_search_terms(user_input)
+        if len(search_terms) > 1:
+            try:
+                await send_bulk_results(update, search_terms)
+            except Exception as e:
+                logger.error(f"Ошибка при массовом поиске: {e}")
+                await update.message.reply_text("❌ *Произошла ошибка при обработке списка артикулов.*", parse_mode='Markdown')
+            return
+
         status_message = await update.message.reply_text("🔍 *Поиск товаров...*", parse_mode='Markdown')
         
         try:
-            products = stock_bot.search_products(user_input)
+            catalog, found = stock_bot.search_indices(user_input)
             
-            if not products:
-                await status_message.edit_text(f"❌ *Товары с артикулом '{user_input}' не найдены.*", parse_mode='Markdown')
+            if not found:
+                await send_rendered(
+                    status_message.edit_text, f"❌ *Товары с артикулом* '{md_escape(user_input)}' *не найдены.*"
+                )
                 return
             
             await status_message.delete()
             
-            for i, product in enumerate(products, 1):
-                product_info = stock_bot.format_product_info(product)
+            for i, idx in enumerate(found, 1):
+                product_info = stock_bot.product_card(catalog, idx)
                 
-                if i == len(products) and stock_bot.file_modify_time:
+                if i == len(found) and stock_bot.file_modify_time:
                     update_time = stock_bot.file_modify_time.strftime('%d.%m.%Y %H:%M')
-                    product_info += f"\n\n⏰ *Данные обновлены:* {update_time}"
+                    product_info += f"\n\n⏰ <b>Данные обновлены:</b> {update_time}"
                 
-                await update.message.reply_text(product_info, parse_mode='Markdown')
+                await send_rendered(update.message.reply_text, product_info, parse_mode='HTML')
                 
         except Exception as e:
             logger.error(f"Ошибка при обработке запроса: {e}")
@@ -773,6 +3452,7 @@ async def approval_button_handler(update: Update, context: ContextTypes.DEFAULT_
             
             if user_data:
                 approve_user(user_id)
+                forget_approval_request(user_id)
                 log_admin_action(ADMIN_ID, "approve_user", user_id)
                 
                 try:
@@ -784,10 +3464,10 @@ async def approval_button_handler(update: Update, context: ContextTypes.DEFAULT_
                 except Exception as e:
                     logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
                 
-                await query.edit_message_text(
-                    f"✅ Пользователь {user_id} подтвержден.\nУведомление отправлено.",
-                    parse_mode='Markdown'
+                text, reply_markup = approval_status_update(
+                    query.message, user_id, f"✅ Пользователь {user_id} подтвержден.\nУведомление отправлено."
                 )
+                await query.edit_message_text(text, reply_markup=reply_markup)
             else:
                 await query.edit_message_text("❌ Пользователь не найден.")
         
@@ -797,6 +3477,7 @@ async def approval_button_handler(update: Update, context: ContextTypes.DEFAULT_
             
             if user_data:
                 block_user(user_id, "Заявка отклонена администратором")
+                forget_approval_request(user_id)
                 log_admin_action(ADMIN_ID, "reject_user", user_id)
                 
                 try:
@@ -808,10 +3489,10 @@ async def approval_button_handler(update: Update, context: ContextTypes.DEFAULT_
                 except Exception as e:
                     logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
                 
-                await query.edit_message_text(
-                    f"❌ Пользователь {user_id} отклонен и заблокирован.\nУведомление отправлено.",
-                    parse_mode='Markdown'
+                text, reply_markup = approval_status_update(
+                    query.message, user_id, f"❌ Пользователь {user_id} отклонен и заблокирован.\nУведомление отправлено."
                 )
+                await query.edit_message_text(text, reply_markup=reply_markup)
             else:
                 await query.edit_message_text("❌ Пользователь не найден.")
     
@@ -823,15 +3504,323 @@ async def approval_button_handler(update: Update, context: ContextTypes.DEFAULT_
             pass
 
 # АДМИН-ПАНЕЛЬ
+USER_LIST_TITLES = {
+    'admin_users': ("👥 *Список пользователей:*", "👥 *Список пользователей пуст*"),
+    'admin_pending': ("⏳ *Запросы на доступ:*", "⏳ *Запросов на доступ нет*"),
+    'admin_blocked': ("🚫 *Заблокированные пользователи:*", "🚫 *Заблокированных пользователей нет*"),
+    'admin_find': ("🔎 *Результаты поиска:*", "🔎 *Пользователи не найдены*")
+}
+
+def format_user_entry(user, kind):
+    """Текст одного пользователя в списке админ-панели (Markdown, данные пользователя экранируются)"""
+    username_display = f"@{md_escape(user.username)}" if user.username else "Без username"
+    name = md_escape(f"{user.first_name or ''} {user.last_name or ''}".strip())
+
+    if kind == 'pending':
+        request_time_str = user.approval_requested.strftime('%d.%m.%Y %H:%M') if user.approval_requested else "Неизвестно"
+        user_info = f"🆔 {user.user_id} - {username_display}"
+        if name:
+            user_info += f"\n👤 {name}"
+        return user_info + f"\n⏰ Запрос: {request_time_str}\n\n"
+
+    if kind == 'blocked':
+        user_info = f"🆔 {user.user_id} - {username_display}"
+        if name:
+            user_info += f"\n👤 {name}"
+        user_info += f"\nПричина: {md_escape(user.block_reason) or 'Не указана'}\n"
+        if user.block_until:
+            user_info += f"До: {user.block_until.strftime('%d.%m.%Y %H:%M')}\n"
+        return user_info + "\n"
+
+    status = "🛠️" if user.user_id == ADMIN_ID else "🚫" if user.is_blocked else "🟢" if user.is_approved else "⏳"
+    last_seen_str = user.last_seen.strftime('%d.%m.%Y %H:%M') if user.last_seen else "Неизвестно"
+    user_info = f"{status} {user.user_id} - {username_display}\n"
+    if name:
+        user_info += f"   Имя: {name}\n"
+    user_info += f"   Запросов: {user.request_count}\n"
+    return user_info + f"   Последняя активность: {last_seen_str}\n\n"
+
+def build_users_page(list_name, kind, cursor=None, search=None):
+    """Текст и клавиатура одной страницы списка пользователей"""
+    page_size = ADMIN_PENDING_PAGE_SIZE if kind == 'pending' else ADMIN_PAGE_SIZE
+    users, next_cursor = get_users_page(kind, cursor, page_size, search)
+    title, empty_title = USER_LIST_TITLES[list_name]
+
+    keyboard = []
+    if not users:
+        text = empty_title
+    else:
+        text = title + "\n\n"
+        for user in users:
+            text += format_user_entry(user, kind)
+            if kind == 'pending':
+                keyboard.append([
+                    InlineKeyboardButton(f"✅ Подтвердить {user.user_id}", callback_data=f"approve_{user.user_id}"),
+                    InlineKeyboardButton(f"❌ Отклонить {user.user_id}", callback_data=f"reject_{user.user_id}")
+                ])
+            elif kind == 'blocked':
+                keyboard.append([
+                    InlineKeyboardButton(f"🔓 Разблокировать {user.user_id}", callback_data=f"unblock_{user.user_id}")
+                ])
+
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=list_name))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton("▶️ Далее", callback_data=f"{list_name}:{next_cursor}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+
+    return text, InlineKeyboardMarkup(keyboard)
+
+LOGS_USAGE = (
+    "📋 *Журнал действий*\n\n"
+    "`/logs` - последние действия\n"
+    "`/logs user=123456789` - по пользователю\n"
+    "`/logs action=approve_user` - по действию\n"
+    "`/logs from=01.05.2024 to=31.05.2024` - за период\n"
+    "`/logs csv` - выгрузка в CSV с теми же фильтрами"
+)
+
+ADMIN_LOG_HEADERS = ['Время', 'Администратор', 'Действие', 'Пользователь', 'Детали']
+
+def parse_logs_args(args):
+    """Разбор аргументов команды /logs в словарь фильтров"""
+    filters_ = {'user': None, 'action': None, 'date_from': None, 'date_to': None, 'csv': False}
+
+    for arg in args:
+        key, _, value = arg.partition('=')
+        key = key.lower()
+        if key == 'csv' and not value:
+            filters_['csv'] = True
+        elif key == 'user':
+            filters_['user'] = int(value)
+        elif key == 'action':
+            filters_['action'] = value
+        elif key in ('from', 'to'):
+            date_value = stock_bot._parse_date(value)
+            if not date_value:
+                raise ValueError(f"Неверная дата: {value}")
+            filters_['date_from' if key == 'from' else 'date_to'] = date_value
+        else:
+            raise ValueError(f"Неизвестный параметр: {arg}")
+    return filters_
+
+def build_logs_page(filters_, cursor=None):
+    """Текст и клавиатура одной страницы журнала действий"""
+    logs, next_cursor = get_admin_logs_page(filters_, cursor)
+
+    conditions = []
+    if filters_.get('user'):
+        conditions.append(f"пользователь {filters_['user']}")
+    if filters_.get('action'):
+        conditions.append(f"действие `{filters_['action']}`")
+    if filters_.get('date_from'):
+        conditions.append(f"с {filters_['date_from'].strftime('%d.%m.%Y')}")
+    if filters_.get('date_to'):
+        conditions.append(f"по {filters_['date_to'].strftime('%d.%m.%Y')}")
+
+    if not logs:
+        logs_text = "📋 *Логов действий нет*"
+    else:
+        logs_text = "📋 *Действия администратора:*\n"
+        if conditions:
+            logs_text += f"🔎 {', '.join(conditions)}\n"
+        logs_text += "\n"
+
+        for log in logs:
+            timestamp_str = log.timestamp.strftime('%d.%m.%Y %H:%M') if log.timestamp else str(log.timestamp)
+
+            logs_text += f"🕐 {timestamp_str}\n"
+            logs_text += f"   Действие: `{log.action}`\n"
+            if log.target_user_id:
+                logs_text += f"   Пользователь: {log.target_user_id}\n"
+            if log.details:
+                logs_text += f"   Детали: {md_escape(log.details)}\n"
+            logs_text += "\n"
+
+    keyboard = []
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data="admin_logs:"))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton("▶️ Далее", callback_data=f"admin_logs:{next_cursor}"))
+    if navigation:
+        keyboard.append(navigation)
+    if logs:
+        keyboard.append([InlineKeyboardButton("📥 Выгрузить в CSV", callback_data="admin_logs_csv")])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+
+    return logs_text, InlineKeyboardMarkup(keyboard)
+
+async def send_admin_logs_csv(message, filters_):
+    """Выгрузка журнала в CSV; запрос и запись файла идут в отдельном потоке"""
+    path = await asyncio.to_thread(write_table_file, ADMIN_LOG_HEADERS, admin_log_rows(filters_), 'csv')
+    try:
+        filename = f"admin_logs_{moscow_now().strftime('%Y%m%d_%H%M')}.csv"
+        with open(path, 'rb') as document:
+            await message.reply_document(document=document, filename=filename, caption="📋 Журнал действий администратора")
+    finally:
+        os.remove(path)
+
+async def logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /logs - журнал действий с фильтрами и выгрузкой"""
+    try:
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        try:
+            filters_ = parse_logs_args(context.args or [])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}\n\n{LOGS_USAGE}", parse_mode='Markdown')
+            return
+
+        # Фильтры нужны и кнопкам листания, а в callback_data помещается только курсор
+        context.user_data['admin_log_filters'] = filters_
+        if filters_['csv']:
+            await send_admin_logs_csv(update.message, filters_)
+            return
+
+        text, reply_markup = build_logs_page(filters_)
+        await send_rendered(update.message.reply_text, text, reply_markup=reply_markup)
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /logs: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при получении логов.")
+
+# Текст сводки собирается один раз на снимок каталога и день (поставки на неделю считаются от сегодня)
+_dashboard_cache = {'catalog': None, 'day': None, 'text': None}
+
+def build_dashboard_text():
+    """Сводка по остаткам из агрегатов снимка (без обхода товаров)"""
+    catalog = stock_bot.catalog
+    today = moscow_now().date()
+    if _dashboard_cache['catalog'] is catalog and _dashboard_cache['day'] == today:
+        return _dashboard_cache['text']
+
+    aggregates = catalog.aggregates
+    format_number = stock_bot._format_number
+    lines = [
+        "📈 *Сводка по остаткам*\n",
+        f"📦 Товаров: {aggregates['products']}",
+        f"🔴 Нет в наличии: {aggregates['zero_stock']}",
+        f"🟡 Заканчиваются (до {format_number(LOW_STOCK_THRESHOLD)}): {aggregates['low_stock']}"
+    ]
+
+    # Поставки на ближайшую неделю: даты в снимке уже отсортированы
+    week = [
+        (date_info['display_date'], quantity)
+        for date_info, (_, quantity) in zip(catalog.shipment_dates, aggregates['shipments'])
+        if date_info['date'] and today <= date_info['date'].date() <= today + timedelta(days=7)
+    ]
+    lines.append("\n🚚 *Поставки на неделю:*")
+    lines.extend(f"• {date_display}: {format_number(quantity)}" for date_display, quantity in week)
+    if not week:
+        lines.append("Поставок нет")
+
+    if aggregates['top_reserved']:
+        lines.append("\n🔒 *Больше всего в резерве:*")
+        for idx, reserve in aggregates['top_reserved']:
+            lines.append(f"• {md_escape(catalog.product(idx)['name'])} - {format_number(reserve)}")
+
+    collections = [entry for entry in aggregates['collections'] if entry[0]]
+    if collections:
+        lines.append("\n📂 *По разделам* (товаров / нет в наличии / резерв / доступно):")
+        for name, count, zero, reserve, available in collections:
+            lines.append(f"• {md_escape(name)}: {count} / {zero} / {format_number(reserve)} / {format_number(available)}")
+
+    if stock_bot.last_update:
+        lines.append(f"\n⏰ Данные от {stock_bot.last_update.strftime('%d.%m.%Y %H:%M')}")
+
+    text = "\n".join(lines)
+    # Длинный список разделов не должен превысить лимит сообщения Telegram
+    if len(text) > 4000:
+        text = text[:4000] + "\n…"
+    _dashboard_cache['catalog'] = catalog
+    _dashboard_cache['day'] = today
+    _dashboard_cache['text'] = text
+    return text
+
+async def dashboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /dashboard - сводка по остаткам"""
+    try:
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+            return
+        if await reply_if_warming(update.message):
+            return
+        await send_rendered(update.message.reply_text, build_dashboard_text())
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /dashboard: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при формировании сводки.")
+
+def build_auto_update_screen():
+    """Экран управления автообновлением: статус, рабочие окна и расписание проверок"""
+    keyboard = [
+        [InlineKeyboardButton("🟢 Включить автообновление", callback_data="auto_update_on")],
+        [InlineKeyboardButton("🔴 Выключить автообновление", callback_data="auto_update_off")],
+        [InlineKeyboardButton("🔄 Выполнить обновление сейчас", callback_data="admin_update")]
+    ]
+    for key, (title, _) in UPDATE_WINDOW_PRESETS.items():
+        mark = "✅" if key == update_scheduler.window else "🕘"
+        keyboard.append([InlineKeyboardButton(f"{mark} {title}", callback_data=f"auto_update_window:{key}")])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+
+    status_text = "🟢 ВКЛЮЧЕНО" if stock_bot.auto_update_enabled else "🔴 ВЫКЛЮЧЕНО"
+    last_update = stock_bot.last_auto_update.strftime('%d.%m.%Y %H:%M') if stock_bot.last_auto_update else "Никогда"
+    next_check = update_scheduler.next_check.strftime('%H:%M') if update_scheduler.next_check else "не назначена"
+    typical_times = ", ".join(update_scheduler.typical_times()) or "пока не определено"
+
+    message_text = (
+        f"⏰ *Управление автообновлением*\n\n"
+        f"Статус: {status_text}\n"
+        f"Последнее обновление: {last_update}\n"
+        f"Рабочие часы: {UPDATE_WINDOW_PRESETS[update_scheduler.window][0]}\n"
+        f"Следующая проверка файла: {next_check}\n"
+        f"Обычное время выгрузки: {typical_times}\n\n"
+        f"Файл проверяется по времени изменения: раз в минуту около обычного времени выгрузки, "
+        f"реже - пока он не меняется и вне рабочих часов.\n\n"
+        f"Выберите действие:"
+    )
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /users - поиск пользователя по ID или username"""
+    try:
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        search = " ".join(context.args or []).strip()
+        if not search:
+            await update.message.reply_text(
+                "🔎 *Поиск пользователя*\n\n`/users 123456789` или `/users @username`",
+                parse_mode='Markdown'
+            )
+            return
+
+        # Запрос хранится в user_data: в callback_data (до 64 байт) помещается только курсор
+        context.user_data['admin_search'] = search
+        text, reply_markup = build_users_page("admin_find", 'users', None, search)
+        await send_rendered(update.message.reply_text, text, reply_markup=reply_markup)
+
+    except Exception as e:
+        logger.error(f"Ошибка в команде /users: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при поиске пользователя.")
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Панель администратора"""
     try:
         if update.effective_user.id != ADMIN_ID:
-            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+            await update.effective_message.reply_text("❌ У вас нет прав для выполнения этой команды.")
             return
         
         keyboard = [
             [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton("📈 Сводка по остаткам", callback_data="admin_dashboard")],
             [InlineKeyboardButton("👥 Список пользователей", callback_data="admin_users")],
             [InlineKeyboardButton("⏳ Запросы на доступ", callback_data="admin_pending")],
             [InlineKeyboardButton("🚫 Заблокированные", callback_data="admin_blocked")],
@@ -841,16 +3830,22 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        text = (
             "🛠️ *Панель администратора*\n\n"
-            "Выберите действие:",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            "📈 Сводка по остаткам: `/dashboard`\n"
+            "🔎 Поиск пользователя: `/users <ID или username>`\n"
+            "📋 Журнал с фильтрами: `/logs`\n\n"
+            "Выберите действие:"
         )
+        # Кнопка "Назад" приходит как callback - редактируем текущее сообщение
+        if update.callback_query:
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        else:
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
     
     except Exception as e:
         logger.error(f"Ошибка в админ-панели: {e}")
-        await update.message.reply_text("❌ Произошла ошибка при открытии админ-панели.")
+        await update.effective_message.reply_text("❌ Произошла ошибка при открытии админ-панели.")
 
 async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопок админ-панели"""
@@ -865,30 +3860,20 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         data = query.data
         
         if data == "admin_stats":
-            users = get_all_users()
-            total_users = len(users)
-            approved_users = len([u for u in users if u.is_approved])
-            pending_users = len([u for u in users if not u.is_approved and not u.is_blocked and u.user_id != ADMIN_ID])
-            blocked_users = len([u for u in users if u.is_blocked])
-            
-            active_today = 0
-            today = datetime.now(MOSCOW_TZ)
-            for user in users:
-                if user.last_seen:
-                    if (today - user.last_seen).days < 1:
-                        active_today += 1
-            
-            total_requests = sum(user.request_count for user in users if user.request_count)
+            stats = get_user_stats()
+            if stats is None:
+                await query.edit_message_text("❌ Не удалось получить статистику пользователей.")
+                return
             
             stats_text = (
                 f"📊 *Статистика бота*\n\n"
-                f"👥 Всего пользователей: {total_users}\n"
+                f"👥 Всего пользователей: {stats['total']}\n"
                 f"🛠️ Администраторов: 1\n"
-                f"🟢 Подтвержденных: {approved_users}\n"
-                f"⏳ Ожидают подтверждения: {pending_users}\n"
-                f"🚫 Заблокированных: {blocked_users}\n"
-                f"📨 Активных за сегодня: {active_today}\n"
-                f"📨 Всего запросов: {total_requests}\n"
+                f"🟢 Подтвержденных: {stats['approved']}\n"
+                f"⏳ Ожидают подтверждения: {stats['pending']}\n"
+                f"🚫 Заблокированных: {stats['blocked']}\n"
+                f"📨 Активных за сегодня: {stats['active_today']}\n"
+                f"📨 Всего запросов: {stats['total_requests']}\n"
                 f"📦 Товаров в базе: {len(stock_bot.products)}\n"
                 f"📅 Дат поставок: {len(stock_bot.shipment_dates)}\n"
                 f"📡 Источник данных: {stock_bot.data_source}\n"
@@ -900,123 +3885,29 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 update_time = stock_bot.last_update.strftime('%d.%m.%Y %H:%M')
                 stats_text += f"\n⏰ Последнее обновление: {update_time}"
             
-            await query.edit_message_text(stats_text, parse_mode='Markdown')
-            
-        elif data == "admin_users":
-            users = get_all_users()
-            if not users:
-                await query.edit_message_text("👥 *Список пользователей пуст*", parse_mode='Markdown')
-                return
-            
-            users_text = "👥 *Список пользователей:*\n\n"
-            
-            for user in users[:15]:
-                status = "🛠️" if user.user_id == ADMIN_ID else "🚫" if user.is_blocked else "🟢" if user.is_approved else "⏳"
-                username_display = f"@{user.username}" if user.username else "Без username"
-                name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                
-                last_seen_str = user.last_seen.strftime('%d.%m.%Y %H:%M') if user.last_seen else "Неизвестно"
-                
-                users_text += f"{status} {user.user_id} - {username_display}\n"
-                if name:
-                    users_text += f"   Имя: {name}\n"
-                users_text += f"   Запросов: {user.request_count}\n"
-                users_text += f"   Последняя активность: {last_seen_str}\n\n"
+            if metrics.enabled:
+                metrics_text = format_metrics_summary()
+                if metrics_text:
+                    stats_text += f"\n\n⏱️ *Производительность:*\n{metrics_text}"
             
-            if len(users) > 15:
-                users_text += f"... и еще {len(users) - 15} пользователей"
+            await query.edit_message_text(stats_text, parse_mode='Markdown')
             
+        elif data == "admin_dashboard":
             keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(users_text, reply_markup=reply_markup, parse_mode='Markdown')
-            
-        elif data == "admin_pending":
-            pending_users = get_pending_approvals()
-            
-            if not pending_users:
-                pending_text = "⏳ *Запросов на доступ нет*"
-                keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(pending_text, reply_markup=reply_markup, parse_mode='Markdown')
-                return
+            await send_rendered(query.edit_message_text, build_dashboard_text(), reply_markup=InlineKeyboardMarkup(keyboard))
             
-            pending_text = "⏳ *Запросы на доступ:*\n\n"
-            keyboard = []
-            
-            for user in pending_users:
-                username_display = f"@{user.username}" if user.username else "Без username"
-                name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                
-                request_time_str = user.approval_requested.strftime('%d.%m.%Y %H:%M') if user.approval_requested else "Неизвестно"
-                
-                user_info = f"🆔 {user.user_id}"
-                if username_display:
-                    user_info += f" - {username_display}"
-                if name:
-                    user_info += f"\n👤 {name}"
-                user_info += f"\n⏰ Запрос: {request_time_str}"
-                
-                pending_text += f"{user_info}\n\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(f"✅ Подтвердить {user.user_id}", callback_data=f"approve_{user.user_id}"),
-                    InlineKeyboardButton(f"❌ Отклонить {user.user_id}", callback_data=f"reject_{user.user_id}")
-                ])
-            
-            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(pending_text, reply_markup=reply_markup, parse_mode='Markdown')
-            
-        elif data == "admin_blocked":
-            users = get_all_users()
-            blocked_users = [u for u in users if u.is_blocked and u.user_id != ADMIN_ID]
-            
-            if not blocked_users:
-                blocked_text = "🚫 *Заблокированных пользователей нет*"
-                keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(blocked_text, reply_markup=reply_markup, parse_mode='Markdown')
-                return
-            
-            blocked_text = "🚫 *Заблокированные пользователи:*\n\n"
-            keyboard = []
-            
-            for user in blocked_users:
-                username_display = f"@{user.username}" if user.username else "Без username"
-                name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                
-                block_info = f"Причина: {user.block_reason or 'Не указана'}\n"
-                if user.block_until:
-                    if datetime.now(MOSCOW_TZ) < user.block_until:
-                        block_info += f"До: {user.block_until.strftime('%d.%m.%Y %H:%M')}\n"
-                    else:
-                        unblock_user(user.user_id)
-                        continue
-                
-                user_info = f"🆔 {user.user_id}"
-                if username_display:
-                    user_info += f" - {username_display}"
-                if name:
-                    user_info += f"\n👤 {name}"
-                user_info += f"\n{block_info}"
-                
-                blocked_text += f"{user_info}\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(f"🔓 Разблокировать {user.user_id}", callback_data=f"unblock_{user.user_id}")
-                ])
-            
-            keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(blocked_text, reply_markup=reply_markup, parse_mode='Markdown')
+        elif data.split(':')[0] in ("admin_users", "admin_pending", "admin_blocked", "admin_find"):
+            # Формат: admin_<список>[:<курсор страницы>]
+            list_name, _, cursor = data.partition(':')
+            kind = 'users' if list_name == "admin_find" else list_name[len("admin_"):]
+            search = context.user_data.get('admin_search') if list_name == "admin_find" else None
+            text, reply_markup = build_users_page(list_name, kind, cursor or None, search)
+            await send_rendered(query.edit_message_text, text, reply_markup=reply_markup)
             
         elif data == "admin_update":
             await query.edit_message_text("🔄 *Обновление данных...*", parse_mode='Markdown')
             
-            success = stock_bot.load_data()
+            success = await asyncio.to_thread(stock_bot.load_data)
             
             if success:
                 update_time = datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')
@@ -1030,6 +3921,9 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 log_admin_action(ADMIN_ID, "update_data")
             else:
                 response = "❌ *Ошибка при обновлении данных*"
+                if stock_bot.schema_error:
+                    response += "\n\n⚠️ Структура файла изменилась, используются предыдущие данные"
+            await notify_schema_error(context.bot)
             
             keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1037,68 +3931,43 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.edit_message_text(response, reply_markup=reply_markup, parse_mode='Markdown')
             
         elif data == "admin_auto_update":
-            keyboard = [
-                [InlineKeyboardButton("🟢 Включить автообновление", callback_data="auto_update_on")],
-                [InlineKeyboardButton("🔴 Выключить автообновление", callback_data="auto_update_off")],
-                [InlineKeyboardButton("🔄 Выполнить обновление сейчас", callback_data="admin_update")],
-                [InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            status_text = "🟢 ВКЛЮЧЕНО" if stock_bot.auto_update_enabled else "🔴 ВЫКЛЮЧЕНО"
-            last_update = stock_bot.last_auto_update.strftime('%d.%m.%Y %H:%M') if stock_bot.last_auto_update else "Никогда"
-            
-            message_text = (
-                f"⏰ *Управление автообновлением*\n\n"
-                f"Статус: {status_text}\n"
-                f"Последнее обновление: {last_update}\n"
-                f"Интервал: 5 минут\n\n"
-                f"Выберите действие:"
-            )
-            
+            message_text, reply_markup = build_auto_update_screen()
             await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
             
         elif data == "auto_update_on":
             stock_bot.auto_update_enabled = True
             log_admin_action(ADMIN_ID, "auto_update_on")
-            await query.answer("✅ Автообновление включено")
-            await admin_button_handler(update, context)
+            message_text, reply_markup = build_auto_update_screen()
+            await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
             
         elif data == "auto_update_off":
             stock_bot.auto_update_enabled = False
             log_admin_action(ADMIN_ID, "auto_update_off")
-            await query.answer("🔴 Автообновление выключено")
-            await admin_button_handler(update, context)
-            
-        elif data == "admin_logs":
-            session = Session()
-            try:
-                logs = session.query(AdminLog).order_by(AdminLog.timestamp.desc()).limit(20).all()
-                
-                if not logs:
-                    logs_text = "📋 *Логов действий нет*"
-                else:
-                    logs_text = "📋 *Последние действия администратора:*\n\n"
-                    
-                    for log in logs:
-                        timestamp_str = log.timestamp.strftime('%d.%m.%Y %H:%M') if log.timestamp else str(log.timestamp)
-                        
-                        logs_text += f"🕐 {timestamp_str}\n"
-                        logs_text += f"   Действие: {log.action}\n"
-                        if log.target_user_id:
-                            logs_text += f"   Пользователь: {log.target_user_id}\n"
-                        if log.details:
-                            logs_text += f"   Детали: {log.details}\n"
-                        logs_text += "\n"
-            except Exception as e:
-                logs_text = f"❌ Ошибка при получении логов: {e}"
-            finally:
-                session.close()
+            message_text, reply_markup = build_auto_update_screen()
+            await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
             
-            keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        elif data.startswith("auto_update_window:"):
+            window = data.split(':', 1)[1]
+            if window in UPDATE_WINDOW_PRESETS:
+                update_scheduler.window = window
+                log_admin_action(ADMIN_ID, "auto_update_window", details=window)
+                # Новое окно действует сразу, а не после уже назначенной проверки
+                if context.job_queue:
+                    schedule_auto_update(context.job_queue)
+            message_text, reply_markup = build_auto_update_screen()
+            await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
             
-            await query.edit_message_text(logs_text, reply_markup=reply_markup, parse_mode='Markdown')
+        elif data == "admin_logs_csv":
+            await query.answer("📥 Формирование файла...")
+            await send_admin_logs_csv(query.message, context.user_data.get('admin_log_filters', {}))
+
+        elif data.split(':')[0] == "admin_logs":
+            # Кнопка из панели сбрасывает фильтры, листание (admin_logs:<курсор>) их сохраняет
+            list_name, paging, cursor = data.partition(':')
+            if not paging:
+                context.user_data['admin_log_filters'] = {}
+            text, reply_markup = build_logs_page(context.user_data.get('admin_log_filters', {}), cursor or None)
+            await send_rendered(query.edit_message_text, text, reply_markup=reply_markup)
             
         elif data.startswith('unblock_'):
             user_id = int(data.split('_')[1])
@@ -1138,47 +4007,117 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Exception while handling an update: {context.error}", exc_info=True)
 
-def main():
-    """Основная функция"""
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(builder=None):
+    """Создание приложения со всеми обработчиками и фоновыми задачами"""
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    builder = builder.concurrent_updates(PriorityUpdateProcessor())
+    if metrics.enabled:
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+    application = builder.build()
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("collections", collections_command))
+    application.add_handler(CommandHandler("arrivals", arrivals_command))
+    application.add_handler(CommandHandler("users", users_command))
+    application.add_handler(CommandHandler("dashboard", dashboard_command))
+    application.add_handler(CommandHandler("logs", logs_command))
     application.add_handler(CallbackQueryHandler(approval_button_handler, pattern="^approve_|^reject_"))
     application.add_handler(CallbackQueryHandler(admin_button_handler, pattern="^admin_|^auto_update_|^unblock_"))
+    application.add_handler(CallbackQueryHandler(arrivals_button_handler, pattern="^arrivals:"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_error_handler(error_handler)
     
+    # Кто из ожидающих уже получил уведомление администратору (для кулдауна после перезапуска)
+    load_approval_state()
+    
     # Настраиваем периодическую задачу для автообновления
     job_queue = application.job_queue
-    job_queue.run_repeating(auto_update_job, interval=300, first=10)
+    if job_queue:
+        schedule_auto_update(job_queue, delay=10)
+        # Снятие временных блокировок по расписанию (в т.ч. истекших, пока бот был выключен)
+        _scheduler['job_queue'] = job_queue
+        schedule_block_expiry()
+        job_queue.run_repeating(flush_admin_logs_job, interval=ADMIN_LOG_FLUSH_INTERVAL, first=ADMIN_LOG_FLUSH_INTERVAL)
+        job_queue.run_repeating(compact_admin_logs_job, interval=24 * 60 * 60, first=10 * 60)
+        if SHARED_DIR:
+            job_queue.run_repeating(shared_snapshot_job, interval=SHARED_SYNC_INTERVAL, first=SHARED_SYNC_INTERVAL)
+    else:
+        logger.warning("⚠️ JobQueue недоступен (нужен python-telegram-bot[job-queue]), автообновление отключено")
     
-    # Запускаем задачу для поддержания активности (только на Render)
+    return application
+
+async def run_webhook_worker(application):
+    """Режим webhook: апдейты приходят на HTTP сервер (от Telegram или другого экземпляра), без getUpdates"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
     if os.environ.get('RENDER'):
+        asyncio.create_task(keep_alive())
+    try:
+        await stop_event.wait()
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+startup_mark("инициализация модуля")
+
+def main():
+    """Основная функция"""
+    webhook_mode = bool(WEBHOOK_URL or WORKER_URLS)
+    if webhook_mode and not WEBHOOK_SECRET:
+        logger.error("❌ Режим webhook требует WEBHOOK_SECRET: без него апдейт от имени любого пользователя не отличить от настоящего")
+        raise SystemExit(1)
+
+    # Создаем приложение
+    application = build_application()
+    startup_mark("сборка приложения")
+    
+    # Запускаем задачу для поддержания активности (только на Render)
+    if os.environ.get('RENDER') and not webhook_mode:
         loop = asyncio.get_event_loop()
         loop.create_task(keep_alive())
     
-    # Предварительная загрузка данных
-    print("🔄 Предварительная загрузка данных...")
-    if stock_bot.load_data():
+    # Снимок каталога (свой или общий) подключается за миллисекунды; без него полная загрузка
+    # идет в фоне уже после запуска бота, свежие данные подтянет первое автообновление
+    if SHARED_DIR and not is_refresh_leader():
+        loaded = stock_bot.sync_shared_snapshot()
+    else:
+        loaded = stock_bot.restore_checkpoint()
+    startup_mark("снимок каталога")
+    if loaded:
         print(f"✅ Данные загружены. Товаров: {len(stock_bot.products)}, Дат поставок: {len(stock_bot.shipment_dates)}")
         print(f"📡 Источник: {stock_bot.data_source}")
         if stock_bot.file_modify_time:
             print(f"⏰ Время обновления файла: {stock_bot.file_modify_time.strftime('%d.%m.%Y %H:%M')}")
     else:
-        print("❌ Не удалось загрузить данные")
+        print("🔄 Снимка каталога нет, данные загрузятся в фоне после запуска")
+        _warmup['needed'] = True
     
     # Запускаем бота
     print("🤖 Бот запущен...")
-    print("🔄 Автообновление данных каждые 5 минут")
+    print(f"🔄 Автообновление по изменению файла: {UPDATE_WINDOW_PRESETS[update_scheduler.window][0]}")
     print("⏰ Время отображается по Москве")
     print("👥 Система подтверждения пользователей активирована")
     print(f"🛠️ Администратор: {ADMIN_ID}")
     print("🌐 Хостинг: Render.com" if os.environ.get('RENDER') else "🌐 Хостинг: Локальный")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if webhook_mode:
+        print(f"🔗 Режим webhook: экземпляр {WORKER_INDEX + 1} из {max(len(WORKER_URLS), 1)}")
+        asyncio.run(run_webhook_worker(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()